@@ -7,7 +7,6 @@ import json
 import sys
 import ctwiz
 import logging
-import time
 
 ARG_CLIENT_ID                   = 1
 ARG_CLIENT_SECRET               = 2
@@ -79,48 +78,83 @@ def set_logging_level(level):
 #     "https" : https_proxy
 # }
 
-def pull_projects(project_id, is_root, include_archived):
+# Maximum number of project listing requests in flight at once
+PROJECT_FETCH_CONCURRENCY = 8
 
-    projects = []
+def query_projects(project_id, is_root, include_archived):
 
-    query       = ctwiz.get_qry_all_projects()
+    query       = ctwiz.get_qry_project_tree()
     variables   = {}
 
     if is_root == True:
-        variables   = ctwiz.get_qry_vars_parent_project(project_id, is_root, include_archived)
+        variables   = ctwiz.get_qry_vars_project_tree_root(project_id, include_archived)
     else:
         # Therefore looking for child projects
-        variables   = ctwiz.get_qry_vars_child_projects(project_id, include_archived)
+        variables   = ctwiz.get_qry_vars_project_tree_children(project_id, include_archived)
 
     print("Querying with variables: " + project_id + " - " + str(is_root) + " - " + str(include_archived))
-    results     = ctwiz.query_wiz_api(query, variables, wiz_datacenter)
-
-    for result in results["data"]["projects"]["nodes"]:
-        this_project_id     = result["id"]
-        this_project_name   = result["name"]
-        this_project_slug   = result["slug"]
-        this_project_is_archived = result["archived"]
-        this_project_is_folder = result["isFolder"]
-        this_project_child_project_count = result["childProjectCount"]
-        this_project_child_projects = []
-        
-        if this_project_child_project_count > 0:
-            is_root = False
-            print("Recursing to find projects with parent project id: " + this_project_id)
-            this_project_child_projects = pull_projects(this_project_id, is_root, include_archived)
-
-        this_project = {}
-        this_project["id"] = this_project_id
-        this_project["name"] = this_project_name
-        this_project["slug"] = this_project_slug
-        this_project["is_archived"] = this_project_is_archived
-        this_project["is_folder"] = this_project_is_folder
-        this_project["child_projects"] = this_project_child_projects
 
+    projects = []
+    for page in ctwiz.iter_connection_pages(query, variables, wiz_datacenter, "projects"):
+        projects.extend(page)
+
+    return projects
+
+def new_project(result):
+
+    this_project = {}
+    this_project["id"] = result["id"]
+    this_project["name"] = result["name"]
+    this_project["slug"] = result["slug"]
+    this_project["is_archived"] = result["archived"]
+    this_project["is_folder"] = result["isFolder"]
+    this_project["child_projects"] = []
+
+    return this_project
+
+# pull_projects()
+# Walks the project tree breadth-first. The children of every folder at the same
+# depth are fetched concurrently, so walk time scales with the depth of the tree.
+
+def pull_projects(project_id, is_root, include_archived):
+
+    projects = []
+
+    # Folders whose children are still to be fetched
+    frontier = []
+
+    for result in query_projects(project_id, is_root, include_archived):
+        this_project = new_project(result)
         projects.append(this_project)
 
+        if result["childProjectCount"] > 0:
+            frontier.append(this_project)
+
+    while len(frontier) > 0:
+
+        for this_project in frontier:
+            print("Fetching projects with parent project id: " + this_project["id"])
+
+        args_list = [(this_project["id"], False, include_archived) for this_project in frontier]
+        child_results_list = ctwiz.run_concurrently(query_projects, args_list, PROJECT_FETCH_CONCURRENCY)
+
+        next_frontier = []
+
+        for this_project, child_results in zip(frontier, child_results_list):
+            for result in child_results:
+                child_project = new_project(result)
+                this_project["child_projects"].append(child_project)
+
+                if result["childProjectCount"] > 0:
+                    next_frontier.append(child_project)
+
+        frontier = next_frontier
+
     return projects
 
+# Paces project mutations to whatever rate the tenant accepts
+mutation_rate_limiter = ctwiz.AdaptiveRateLimiter()
+
 def update_project(project_id, current_project_name, project_name_suffix, current_project_slug, project_slug_suffix, current_project_archive_status, target_archive_status):
 
     new_project_name = current_project_name + project_name_suffix
@@ -133,25 +167,43 @@ def update_project(project_id, current_project_name, project_name_suffix, curren
     
     query       = ctwiz.get_qry_update_project()
     variables   = ctwiz.get_qry_vars_update_project(project_id, new_project_name, new_project_slug, target_archive_status)
-    results     = ctwiz.query_wiz_api(query, variables, wiz_datacenter)
+    results     = ctwiz.query_wiz_api(query, variables, wiz_datacenter, mutation_rate_limiter)
+
+    if isinstance(results, Exception):
+        logging.error("Failed to update project with id: " + project_id + " - " + str(results))
+        return
 
     if results["data"]["updateProject"]["project"]["id"] == project_id:
         logging.info("Successfully updated project with id: " + results["data"]["updateProject"]["project"]["id"] + " to name " + results["data"]["updateProject"]["project"]["name"])
-        time.sleep(5)
+
+# Maximum number of project updates in flight at once
+PROJECT_UPDATE_CONCURRENCY = 8
+
+def group_projects_by_depth(all_projects):
+
+    levels = []
+    this_level = all_projects
+
+    while len(this_level) > 0:
+        levels.append(this_level)
+        this_level = [child_project for project in this_level for child_project in project["child_projects"]]
+
+    return levels
+
+# loop_and_update_projects()
+# Updates the project tree one depth at a time, starting from the deepest level.
+# All projects at a given depth are updated concurrently, and every child is
+# updated before its parent.
 
 def loop_and_update_projects(all_projects, project_name_suffix, slug_suffix, target_archive_status):
 
-    for project in all_projects:
+    levels = group_projects_by_depth(all_projects)
 
-        if len(project["child_projects"]) > 0:
-            logging.info("Recursing to update projects with parent project id: " + project["id"])
-            loop_and_update_projects(project["child_projects"], project_name_suffix, slug_suffix, target_archive_status)
-        elif len(project["child_projects"]) == 0:
-            update_project(project["id"], project["name"], project_name_suffix, project["slug"], slug_suffix, project["is_archived"], target_archive_status)
-            continue
+    for depth in reversed(range(len(levels))):
+        logging.info("Updating " + str(len(levels[depth])) + " projects at depth " + str(depth))
 
-        # Hit here, assuming all child projects have been updated, time to update this project itself
-        update_project(project["id"], project["name"], project_name_suffix, project["slug"], slug_suffix, project["is_archived"], target_archive_status)
+        args_list = [(project["id"], project["name"], project_name_suffix, project["slug"], slug_suffix, project["is_archived"], target_archive_status) for project in levels[depth]]
+        ctwiz.run_concurrently(update_project, args_list, PROJECT_UPDATE_CONCURRENCY)
 
 def main():
 
@@ -186,7 +238,10 @@ def main():
             loop_and_update_projects(all_projects, set_project_name_suffix, set_slug_suffix, set_archive_status)
         if proceed == "N":
             print("Will not proceed.")
+            ctwiz.close_wiz_session()
             exit(1)
 
+    ctwiz.close_wiz_session()
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
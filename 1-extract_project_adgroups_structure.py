@@ -8,6 +8,9 @@ import json
 import sys
 import ctwiz
 import logging
+import csv
+import atexit
+import threading
 
 ARG_CLIENT_ID                   = 1
 ARG_CLIENT_SECRET               = 2
@@ -89,8 +92,57 @@ gcp_entity_matrix = [
     {"index": 9, "entity_type": "subscription", "parent_index": 0},
 ]
 
+# compile_lineage_table()
+# Precomputes, for each entity index of an entity matrix, the entity indexes from the
+# root down to and including that entity.
+
+def compile_lineage_table(entity_matrix):
+
+    parent_indexes = [None] * len(entity_matrix)
+    for entity in entity_matrix:
+        parent_indexes[entity["index"]] = entity["parent_index"]
+
+    lineage_table = []
+    for index in range(len(entity_matrix)):
+        lineage = [index]
+        while parent_indexes[lineage[-1]] != None:
+            lineage.append(parent_indexes[lineage[-1]])
+        lineage.reverse()
+        lineage_table.append(tuple(lineage))
+
+    return lineage_table
+
+entity_lineage_tables = {
+    "Azure":    compile_lineage_table(azure_entity_matrix),
+    "AWS":      compile_lineage_table(aws_entity_matrix),
+    "GCP":      compile_lineage_table(gcp_entity_matrix),
+}
+
 project_counter = 0
 
+# Maximum number of group membership lookups in flight at once
+GROUP_MEMBER_FETCH_CONCURRENCY = 16
+
+# Number of subscriptions whose members are resolved per graphSearch
+SUBSCRIPTION_MEMBER_BATCH_SIZE = 50
+
+# Maximum number of partitioned project structure sub-queries run at once beneath
+# each capped management group
+PARTITION_FETCH_CONCURRENCY = 8
+
+# Maximum number of root management groups fetched at once
+ROOT_FETCH_CONCURRENCY = 4
+
+# Maximum number of project structure requests in flight at once, across every root
+# and partition. Root and partition fetches nest, so their own limits multiply; this
+# bounds the total, and keeps it within ctwiz.DEFAULT_POOL_MAXSIZE connections.
+STRUCTURE_QUERY_CONCURRENCY = 16
+structure_query_slots = threading.BoundedSemaphore(STRUCTURE_QUERY_CONCURRENCY)
+
+# Group membership lookups queued while the project tree is built. Each entry is
+# (element, group_id, external_id, element_type, project_name, cloud).
+pending_group_member_fetches = []
+
 def get_project_code(cloud, entity_path):
 
     short_cloud = ""
@@ -150,6 +202,10 @@ groups = {}
 
 root_structure = {}
 
+# Index of every project element in the project tree, keyed by
+# (entity path, is_folder_project), so elements can be found without walking the tree
+project_index = {}
+
 root_burner_structure = {}
 
 root_burner_structure["Azure"] = {}
@@ -176,6 +232,7 @@ def build_root_structure():
         root_structure[aws_root_wiz_project_name]["parent_project_name"]    = "ROOT"
 
         write_to_project_file(aws_root_wiz_project_name, None, aws_root_wiz_project_name, root_structure[aws_root_wiz_project_name]["is_folder_project"], None, "AWS")
+        index_project_element(root_structure[aws_root_wiz_project_name])
 
         for aws_org in aws_org_list:
             if aws_org["burner_list"]:
@@ -197,14 +254,7 @@ def build_root_structure():
         root_structure[azure_root_wiz_project_name]["parent_project_id"]    = "ROOT"
 
         write_to_project_file(azure_root_wiz_project_name, None, azure_root_wiz_project_name, root_structure[azure_root_wiz_project_name]["is_folder_project"], None, "Azure")
-
-        for azure_org in azure_org_list:
-            if azure_org["burner_list"]:
-                root_burner_structure["Azure"] = {}
-                root_burner_structure["Azure"]["folder_projects"] = {}
-                root_burner_structure["Azure"]["projects"]        = {}
-                root_burner_structure["Azure"]["is_folder_project"] = True
-                break
+        index_project_element(root_structure[azure_root_wiz_project_name])
 
     gcp_org_list = json.loads(gcp_root_org_list)
 
@@ -218,69 +268,117 @@ def build_root_structure():
         root_structure[gcp_root_wiz_project_name]["parent_project_id"]  = "ROOT"
 
         write_to_project_file(gcp_root_wiz_project_name, None, gcp_root_wiz_project_name, root_structure[gcp_root_wiz_project_name]["is_folder_project"], None, "GCP")
-
-        for gcp_org in gcp_org_list:
-            if gcp_org["burner_list"]:
-                root_burner_structure["GCP"] = {}
-                root_burner_structure["GCP"]["folder_projects"] = {}
-                root_burner_structure["GCP"]["projects"]        = {}
-                root_burner_structure["GCP"]["is_folder_project"] = True
-                break
+        index_project_element(root_structure[gcp_root_wiz_project_name])
     
+def build_group_member(user_entity, cloud):
+
+    member = {}
+    member["name"] = user_entity["properties"]["name"]
+    if cloud == "GCP" or cloud == "AWS":
+        member["email"] = user_entity["properties"]["name"]
+    else:
+        member["email"] = user_entity["properties"]["userPrincipalName"]
+
+    return member
+
+# build_burner_root_structure()
+# Creates the top-level folder project that holds this cloud's burner management groups.
+# Called on first use, after every non-burner root has been modelled, so that adding a
+# burner list doesn't change the project codes of the rest of the tree.
+
+def build_burner_root_structure(cloud):
+
+    burner_root_wiz_project_name = cloud + " Burners" + get_project_code(cloud, "Root")
+
+    root_burner_structure[cloud]                           = {}
+    root_burner_structure[cloud]["name"]                   = burner_root_wiz_project_name
+    root_burner_structure[cloud]["folder_projects"]        = {}
+    root_burner_structure[cloud]["projects"]               = {}
+    root_burner_structure[cloud]["is_folder_project"]      = True
+    root_burner_structure[cloud]["path"]                   = burner_root_wiz_project_name
+    root_burner_structure[cloud]["parent_project_name"]    = "ROOT"
+
+    write_to_project_file(burner_root_wiz_project_name, None, burner_root_wiz_project_name, root_burner_structure[cloud]["is_folder_project"], None, cloud)
+    index_project_element(root_burner_structure[cloud])
+
 def get_group_members(external_id, scope_type, cloud):
 
-    query       = ctwiz.get_qry_grp_role_bindings()
+    query       = ctwiz.get_qry_graph_search_lean()
     variables   = ""
     # Adding to dict to ensure duplicate results won't be added.
     group_member_list = []
 
-    if cloud == "AWS" and scope_type == "subscription":
-        variables   = ctwiz.get_qry_vars_grp_members_for_subscriptions(external_id, cloud)
+    if scope_type == "subscription":
+        return get_subscription_group_members([external_id], cloud)[external_id]
     elif cloud == "AWS" and scope_type == "cloud_organization":
         # logging.info("No role bindings for AWS OUs")
         return group_member_list
-    elif cloud == "Azure" and scope_type == "subscription":
-        variables   = ctwiz.get_qry_vars_grp_members_for_subscriptions(external_id, cloud)
     elif cloud == "Azure" and scope_type == "cloud_organization":
         variables   = ctwiz.get_qry_vars_grp_members_for_mgmt_groups(external_id, cloud)
-    elif cloud == "GCP" and scope_type == "subscription":
-        variables   = ctwiz.get_qry_vars_grp_members_for_subscriptions(external_id, cloud)
     elif cloud == "GCP" and scope_type == "cloud_organization":
         variables   = ctwiz.get_qry_vars_grp_members_for_mgmt_groups(external_id, cloud)
 
-    results     = ctwiz.query_wiz_api(query, variables, wiz_datacenter)
+    for page in ctwiz.iter_connection_pages_prefetch(query, variables, wiz_datacenter, "graphSearch"):
+        for result in page:
 
-    # Pagination
-    page_info = results["data"]["graphSearch"]["pageInfo"]
+            entities = result["entities"]
 
-    while(page_info["hasNextPage"]):
-        logging.info("Paginating on get_role_bindings")
-        variables["after"] = page_info["endCursor"]
-        this_results = ctwiz.query_wiz_api(query, variables, wiz_datacenter)
-        results["data"]["graphSearch"]["nodes"].extend(this_results["data"]["graphSearch"]["nodes"])
-        page_info = this_results["data"]["graphSearch"]["pageInfo"]
+            group_member_list.append(build_group_member(entities[0], cloud))
 
-    for result in results["data"]["graphSearch"]["nodes"]:
+    return group_member_list
 
-        entities = result["entities"]
+# get_subscription_group_members()
+# Resolves members for many subscriptions in a single paginated graphSearch.
+# Returns a dict of subscription external id to member list. A batch whose
+# results hit the graphSearch result cap is split in half and each half
+# resolved again, down to a single subscription.
 
-        member = {}
-        member["name"] = entities[0]["properties"]["name"]
-        if cloud == "GCP" or cloud == "AWS":
-            member["email"] = entities[0]["properties"]["name"]
-        else:
-            member["email"] = entities[0]["properties"]["userPrincipalName"]
+def get_subscription_group_members(external_ids, cloud):
 
-        group_member_list.append(member)
+    query       = ctwiz.get_qry_graph_search_lean()
+    variables   = ctwiz.get_qry_vars_grp_members_for_subscriptions_batch(external_ids, cloud)
 
-    return group_member_list
+    group_members = {}
+    for external_id in external_ids:
+        group_members[external_id] = []
+
+    result_count = 0
+    capped = False
+
+    try:
+        for page in ctwiz.iter_connection_pages_prefetch(query, variables, wiz_datacenter, "graphSearch"):
+            result_count = result_count + len(page)
+
+            for result in page:
+
+                entities = result["entities"]
+
+                # entities[0] is the user account, entities[1] the subscription it is bound to
+                external_id = entities[1]["properties"]["externalId"]
+
+                if external_id in group_members:
+                    group_members[external_id].append(build_group_member(entities[0], cloud))
+
+            if result_count >= ctwiz.GRAPH_SEARCH_RESULT_CAP:
+                capped = True
+                break
+    except ctwiz.ResultCapError:
+        capped = True
+
+    if capped and len(external_ids) > 1:
+        logging.info("Hit 10k results limit resolving members of " + str(len(external_ids)) + " subscriptions - splitting the batch")
+        half = len(external_ids) // 2
+        group_members = get_subscription_group_members(external_ids[:half], cloud)
+        group_members.update(get_subscription_group_members(external_ids[half:], cloud))
+    elif capped:
+        logging.warning("Hit 10k results limit resolving members of subscription " + external_ids[0] + " - some of its members will be missing")
+
+    return group_members
 
 def write_ad_group_to_file(group_name, project_name, members_list, cloud):
-    
-    f = open(ad_output_file, "a")
 
     for member in members_list:
-        f.write("\"" + group_name + "\",\"" + project_name + "\",\"" + member["name"] + "\",\"" + member["email"] + "\",\"" + cloud + "\"\n")
+        ad_output_writer.writerow([group_name, project_name, member["name"], member["email"], cloud])
 
 def new_project_element(external_id, project_name, element_type, parent_project_name, burner_mode, entity_path, cloud):
     project_name = project_name + get_project_code(cloud, entity_path)
@@ -303,198 +401,365 @@ def new_project_element(external_id, project_name, element_type, parent_project_
 
     for group_id in ["Wiz_" + str(project_name + "_" + default_user_role)]:
         element["ad_groups"][group_id] = {} 
-        element["ad_groups"][group_id]["members"] = get_group_members(external_id, element_type, cloud)
+        element["ad_groups"][group_id]["members"] = []
 
-        write_ad_group_to_file(group_id, project_name, element["ad_groups"][group_id]["members"], cloud)
+        # Members are resolved later, concurrently, by fetch_pending_group_members()
+        pending_group_member_fetches.append((element, group_id, external_id, element_type, project_name, cloud))
 
     return element
 
+def fetch_group_members_job(external_ids, scope_type, cloud):
 
-def get_entity_lineage_matrix(cloud, target_index, result_list):
+    if scope_type == "subscription":
+        return get_subscription_group_members(external_ids, cloud)
 
-    matrix = get_matrix(cloud)
+    group_members = {}
+    for external_id in external_ids:
+        group_members[external_id] = get_group_members(external_id, scope_type, cloud)
 
-    if result_list == None:
-        
-        result_list = [target_index]
+    return group_members
 
-    if target_index == 0:
-        return result_list
+def fetch_pending_group_members():
 
-    for entity in matrix:
-        if entity["index"] == target_index:
-            return get_entity_lineage_matrix(cloud, entity["parent_index"], [entity["parent_index"]] + result_list)
+    logging.info("Fetching group members for " + str(len(pending_group_member_fetches)) + " projects...")
 
-def build_entity_lineage(cloud, entity_index, entities, mg_friendly_name):
+    # Collect the unique scopes to resolve, grouped by scope type and cloud
+    scopes = {}
+    for (element, group_id, external_id, element_type, project_name, cloud) in pending_group_member_fetches:
+        scope_ids = scopes.setdefault((element_type, cloud), [])
+        if external_id not in scope_ids:
+            scope_ids.append(external_id)
 
-    entity_lineage_matrix = get_entity_lineage_matrix(cloud, entity_index, None)
-    entity_name_lineage_list = []
+    # Subscriptions are resolved in batches, management groups one at a time
+    args_list = []
+    for (element_type, cloud), scope_ids in scopes.items():
+        batch_size = SUBSCRIPTION_MEMBER_BATCH_SIZE if element_type == "subscription" else 1
+        for i in range(0, len(scope_ids), batch_size):
+            args_list.append((scope_ids[i:i + batch_size], element_type, cloud))
 
-    for entry in entity_lineage_matrix:
-        if entity_lineage_matrix.index(entry) == 0:
-            name = mg_friendly_name
-        else:
-            if entities[entry]["name"].find("/") != -1:
-                name = entities[entry]["name"].replace("/","-") 
-            else:
-                name = entities[entry]["name"]
+    members_by_scope = {}
+    for (external_ids, element_type, cloud), group_members in zip(args_list, ctwiz.run_concurrently(fetch_group_members_job, args_list, GROUP_MEMBER_FETCH_CONCURRENCY)):
+        for external_id in external_ids:
+            members_by_scope[(element_type, cloud, external_id)] = group_members[external_id]
+
+    # Join results back onto the project tree and write them out in discovery order
+    for (element, group_id, external_id, element_type, project_name, cloud) in pending_group_member_fetches:
+        members = members_by_scope[(element_type, cloud, external_id)]
+        element["ad_groups"][group_id]["members"] = members
 
-        entity_name_lineage_list = entity_name_lineage_list + [name]
+        write_ad_group_to_file(group_id, project_name, members, cloud)
+
+    pending_group_member_fetches.clear()
+
+def build_entity_lineage(cloud, entity_index, entities, mg_friendly_name):
+
+    entity_lineage_matrix = entity_lineage_tables[cloud][entity_index]
+    entity_name_lineage_list = [mg_friendly_name]
+
+    # Position 0 is always the root management group, named by its friendly name
+    for position in range(1, len(entity_lineage_matrix)):
+        entity_name_lineage_list.append(entities[entity_lineage_matrix[position]]["name"].replace("/","-"))
 
     return entity_name_lineage_list
 
-def find_or_create_cloud_org(this_project, target_entity_index, target_entity_name, target_entity_lineage, target_entity_external_id, burner_mode, entity_path, cloud, parent_project_name):
+def index_project_element(element):
+    project_index[(element["path"], element["is_folder_project"])] = element
 
-    next_entity_lineage = None
-    if len(target_entity_lineage) > 0:
-        next_entity_lineage = target_entity_lineage.pop(0)
+# find_or_create_project_element()
+# Finds the project element for this entity in the project tree, creating it beneath
+# its parent folder project if it does not exist yet. The parent is looked up by
+# path, so each call costs a couple of dict lookups regardless of tree depth.
 
-    # Are we at the correct entity_lineage and is the current project a folder project?
-    if len(target_entity_lineage) == 0 and next_entity_lineage == target_entity_name and this_project["is_folder_project"] == True:
+def find_or_create_project_element(root_wiz_project_name, entity_type, entity_name, entity_lineage, entity_external_id, burner_mode, entity_path, cloud):
 
-        # Return this project if the target folder project already exists within this folder project
-        if next_entity_lineage in this_project["folder_projects"].keys():
-            return this_project
-        else:
-            # Create new project element here if it doesn't already exists and should exist here
-            parent_project_name = this_project["name"]
-            this_project["folder_projects"][next_entity_lineage] = new_project_element(target_entity_external_id, target_entity_name, "cloud_organization", parent_project_name, burner_mode, entity_path, cloud)
-            return this_project
-    # Have we stumbled across a project instead of a folder project within the structure? If so return back this_project
-    elif this_project["is_folder_project"] == False:
-        return this_project
-
-    # Do we still have further lineage to traverse and is the current project a folder project?
-    if len(target_entity_lineage) > 0 and this_project["is_folder_project"] == True:
-
-        # Recurse if the target next entity lineage
-        if next_entity_lineage in this_project["folder_projects"].keys():
-            parent_project_name = this_project["name"]
-            this_project["folder_projects"][next_entity_lineage] = find_or_create_cloud_org(this_project["folder_projects"][next_entity_lineage], target_entity_index, target_entity_name, target_entity_lineage, target_entity_external_id, burner_mode, entity_path, cloud, parent_project_name)
-            return this_project
-
-    return this_project
-
-def find_or_create_subscription(this_project, target_entity_index, target_entity_name, target_entity_lineage, target_entity_external_id, burner_mode, entity_path, cloud, parent_project_id):
-
-    next_entity_lineage = None
-    if len(target_entity_lineage) > 0:
-        next_entity_lineage = target_entity_lineage.pop(0)
-
-    # Create new project element if it doesn't exist
-    if len(target_entity_lineage) == 0 and next_entity_lineage == target_entity_name:
-
-        # Return project if it already exists
-        if next_entity_lineage in this_project["projects"].keys():
-            return this_project
-        
-        # Create new project if it doesn't exist
-        else:
-            parent_project_name = this_project["name"]
-            this_project["projects"][next_entity_lineage] = new_project_element(target_entity_external_id, target_entity_name, "subscription", parent_project_name, burner_mode, entity_path, cloud)
-            return this_project
+    is_folder_project = entity_type == "cloud_organization"
+
+    element = project_index.get((entity_path, is_folder_project))
+    if element != None:
+        return element
 
-    # Next entity lineage is within this folder project, so we'll need to recurse down to it
-    if len(target_entity_lineage) > 0 and this_project["is_folder_project"] == True:
-        if next_entity_lineage in this_project["folder_projects"].keys():
-            parent_project_name = this_project["name"]
-            this_project["folder_projects"][next_entity_lineage] = find_or_create_subscription(this_project["folder_projects"][next_entity_lineage], target_entity_index, target_entity_name, target_entity_lineage, target_entity_external_id, burner_mode, entity_path, cloud, parent_project_name)
-            return this_project
+    parent_path = "/".join([root_wiz_project_name] + entity_lineage[:-1])
+    parent_project = project_index.get((parent_path, True))
 
+    # Parent folder project has not been created - nothing to attach this entity to
+    if parent_project == None:
+        return None
+
+    element = new_project_element(entity_external_id, entity_name, entity_type, parent_project["name"], burner_mode, entity_path, cloud)
+
+    if is_folder_project:
+        parent_project["folder_projects"][entity_name] = element
+    else:
+        parent_project["projects"][entity_name] = element
+
+    index_project_element(element)
+
+    return element
+
+# collect_unique_entities()
+# Collapses graphSearch rows into the unique set of (entity id, parent entity id, entity type)
+# edges. A management group appears in every row beneath it, so this removes the repeated
+# work of building its lineage, path and tree lookup. Returns (entity index, row entities)
+# for the first row each edge was seen in, in first-seen order - which always places a
+# parent before its children. Edges already in seen_edges are skipped.
+
+def collect_unique_entities(results, cloud, seen_edges):
+
+    matrix = get_matrix(cloud)
+    unique_entities = []
+
+    for result in results:
+
+        entities = result["entities"]
+
+        for entity_index, entity in enumerate(entities):
+
+            if entity is None:
+                continue
+
+            parent_index = matrix[entity_index]["parent_index"]
+            parent_id = entities[parent_index]["id"] if parent_index != None else None
+            edge = (entity["id"], parent_id, matrix[entity_index]["entity_type"])
+
+            if edge not in seen_edges:
+                seen_edges.add(edge)
+                unique_entities.append((entity_index, entities))
+
+    return unique_entities
+
+# get_structure_variables()
+# Returns the project structure query variables for a root management group, excluding its
+# first burner management group if it has one
+
+def get_structure_variables(root_mg_id, cloud, mg_burner_list):
+
+    if cloud == "Azure" and len(mg_burner_list) != 0:
+        variables = ctwiz.get_qry_vars_azure_project_structure_excl_burners(root_mg_id, mg_burner_list[0])
+    elif cloud == "GCP" and len(mg_burner_list) != 0:
+        variables = ctwiz.get_qry_vars_gcp_project_structure_excl_burners(root_mg_id, mg_burner_list[0])
+    elif cloud == "GCP":
+        variables = ctwiz.get_qry_vars_gcp_project_structure_excl_burners(root_mg_id, "")
+    else:
+        variables = ctwiz.get_qry_vars_project_structure_no_burners(root_mg_id, cloud)
+
+    return variables
+
+def get_partition_variables(root_mg_id, cloud, mg_burner_list):
+
+    return ctwiz.get_qry_vars_partition(get_structure_variables(root_mg_id, cloud, mg_burner_list))
+
+def get_root_wiz_project_name(cloud):
+
+    if cloud == "Azure":
+        return azure_root_wiz_project_name
+    elif cloud == "GCP":
+        return gcp_root_wiz_project_name
+    else:
+        return aws_root_wiz_project_name
 
-def model_project_structure(burner_mode, root_mg_id, cloud, mg_friendly_name, mg_burner_list):
+# fetch_root_project_structure()
+# Runs every query needed to model one root management group, without touching the project
+# tree. Each page of the root's own query is passed to on_page as it arrives; anything else,
+# such as partitions, is returned. Returns None if there is nothing to model for this root.
+
+def fetch_root_project_structure(on_page, burner_mode, root_mg_id, cloud, mg_friendly_name, mg_burner_list):
 
     logging.info("Cloud: " + cloud + " - Burner Mode: " + str(burner_mode) + " - Root Mgmt Group: " + root_mg_id)
-    query       = ctwiz.get_qry_project_structure()
-    variables   = {}
-    root_wiz_project_name = ""
-    
-    if burner_mode      == True and cloud == "Azure" and len(mg_burner_list) != 0:
-        variables   = ctwiz.get_qry_vars_azure_project_structure_burners(root_mg_id, mg_burner_list[0])
-        root_wiz_project_name = azure_root_wiz_project_name
-    elif burner_mode    == False and cloud == "Azure" and len(mg_burner_list) != 0:
-        variables  = ctwiz.get_qry_vars_azure_project_structure_excl_burners(root_mg_id, mg_burner_list[0])
-        root_wiz_project_name = azure_root_wiz_project_name 
-    elif burner_mode    == False and cloud == "Azure" and len(mg_burner_list) == 0:
-        root_wiz_project_name = azure_root_wiz_project_name
-        variables  = ctwiz.get_qry_vars_project_structure_no_burners(root_mg_id, cloud)
-    elif burner_mode    == True and cloud == "GCP":
-        root_wiz_project_name = cloud
-        logging.info("Not catering for GCP burners - too many results to process. They will be excluded from project creation and should be added to a new project manually later on")
-        return None
-    elif burner_mode    == False and cloud == "GCP" and len(mg_burner_list) > 0:
-        root_wiz_project_name = gcp_root_wiz_project_name
-        variables   = ctwiz.get_qry_vars_gcp_project_structure_excl_burners(root_mg_id, mg_burner_list[0])
-    elif burner_mode    == False and cloud == "GCP" and len(mg_burner_list) == 0:
-        root_wiz_project_name = gcp_root_wiz_project_name
-        variables   = ctwiz.get_qry_vars_gcp_project_structure_excl_burners(root_mg_id, "")        
-    elif burner_mode    == True and cloud == "AWS":
+
+    if burner_mode == True and cloud == "AWS":
         logging.info("No burner mode for AWS")
         return None
-    elif burner_mode    == False and cloud == "AWS":
-        root_wiz_project_name = aws_root_wiz_project_name
-        variables  = ctwiz.get_qry_vars_project_structure_no_burners(root_mg_id, cloud)
-    
-    results     = ctwiz.query_wiz_api(query, variables, wiz_datacenter)
 
-    # Pagination
-    page_info = results["data"]["graphSearch"]["pageInfo"]
-    try:
-        while(page_info["hasNextPage"]):
-            logging.info("Paginating on model_project_structure")
-            variables["after"] = page_info["endCursor"]
-            this_results = ctwiz.query_wiz_api(query, variables, wiz_datacenter)
-            results["data"]["graphSearch"]["nodes"].extend(this_results["data"]["graphSearch"]["nodes"])
-            page_info = this_results["data"]["graphSearch"]["pageInfo"]
-    except TypeError:
-        logging.info("Hit 10k results limit")
+    if burner_mode == True:
+        if len(mg_burner_list) == 0:
+            return None
+
+        # Burner management groups can hold very many subscriptions, so are always partitioned
+        burner_mg_id = mg_burner_list[0]
+        burner_folder_name = mg_friendly_name + " Burners"
+
+        return {"pages": [], "partition": fetch_partitioned_structure(burner_mg_id, cloud, burner_folder_name, []), "burner_mg_id": burner_mg_id}
+
+    return fetch_structure(get_structure_variables(root_mg_id, cloud, mg_burner_list), root_mg_id, cloud, mg_friendly_name, mg_burner_list, on_page)
+
+# fetch_structure()
+# Runs a project structure query. If it hits the graphSearch result cap, the tree beneath
+# root_mg_id is also fetched partitioned, one sub-query per child management group. Pages
+# are passed to on_page if given, otherwise they are kept in the returned structure.
+
+def fetch_structure(variables, root_mg_id, cloud, root_entity_name, mg_burner_list, on_page=None):
+
+    pages = []
+    capped = stream_project_structure(variables, on_page if on_page is not None else pages.append)
 
     logging.info("Exited Pagination")
 
-    logging.info(str(len(results["data"]["graphSearch"]["nodes"])) + " Results fetched")
-    
-    matrix = get_matrix(cloud)
+    partition = None
 
-    i = 0
-    for result in results["data"]["graphSearch"]["nodes"]:
-        i = i + 1
+    if capped:
+        logging.info("Hit 10k results limit - partitioning " + root_entity_name + " into per-child queries")
+        partition = fetch_partitioned_structure(root_mg_id, cloud, root_entity_name, mg_burner_list)
 
-        # if i == 11:
-        #     break
+    return {"pages": pages, "partition": partition}
 
-        logging.info("Processing result " + str(i) + " of " + str(len(results["data"]["graphSearch"]["nodes"])))
+# stream_project_structure()
+# Runs a project structure query, passing each page of results to on_page as it arrives.
+# Returns True if the results were cut short by the graphSearch result cap.
 
-        entities = result["entities"]
+def stream_project_structure(variables, on_page):
+
+    query       = ctwiz.get_qry_graph_search_lean()
+    result_count = 0
+
+    try:
+        for page in ctwiz.iter_connection_pages_prefetch(query, variables, wiz_datacenter, "graphSearch", request_slots=structure_query_slots):
+            result_count = result_count + len(page)
+            logging.info(str(result_count) + " Results fetched")
+
+            on_page(page)
+
+            if result_count >= ctwiz.GRAPH_SEARCH_RESULT_CAP:
+                return True
+    except ctwiz.ResultCapError:
+        return True
+
+    return False
+
+# fetch_partitioned_structure()
+# Lists the direct children of a management group, then fetches the tree beneath each child
+# management group with its own sub-query. Sub-queries run concurrently, and a child whose
+# sub-query also hits the result cap is partitioned in turn.
+
+def fetch_partitioned_structure(root_mg_id, cloud, root_entity_name, mg_burner_list):
+
+    query       = ctwiz.get_qry_graph_search_lean()
+    variables   = ctwiz.get_qry_vars_child_entities(root_mg_id)
+
+    # Matches the structure queries, which only exclude the first burner management group
+    excluded_mg_ids = mg_burner_list[:1]
+
+    children = []
+
+    try:
+        for page in ctwiz.iter_connection_pages_prefetch(query, variables, wiz_datacenter, "graphSearch", request_slots=structure_query_slots):
+            for result in page:
+
+                child = result["entities"][1]
+
+                if child is None or child["properties"]["externalId"] in excluded_mg_ids:
+                    continue
+
+                children.append(child)
+    except ctwiz.ResultCapError:
+        logging.warning("Hit 10k results limit listing the children of " + root_entity_name + " - some of its children will be missing")
+
+    child_orgs = [child for child in children if child["type"] == "CLOUD_ORGANIZATION"]
+
+    logging.info("Querying " + str(len(child_orgs)) + " partitions of " + root_entity_name)
+
+    args_list = [(get_partition_variables(child["properties"]["externalId"], cloud, mg_burner_list), child["properties"]["externalId"], cloud, child["name"].replace("/","-"), mg_burner_list) for child in child_orgs]
+    partitions = ctwiz.run_concurrently(fetch_structure, args_list, PARTITION_FETCH_CONCURRENCY)
+
+    return {"children": children, "partitions": partitions}
+
+# model_project_structure()
+# Adds a fetched root management group to the project tree
+
+def model_project_structure(burner_mode, cloud, mg_friendly_name, structure):
+
+    if structure is None:
+        return None
+
+    if burner_mode == True:
+        model_burner_structure(cloud, mg_friendly_name, structure)
+    else:
+        build_structure(structure, cloud, mg_friendly_name, [], get_root_wiz_project_name(cloud), burner_mode)
+
+# model_burner_structure()
+# Adds a fetched burner management group to the tree as its own folder project beneath this
+# cloud's burner root
+
+def model_burner_structure(cloud, mg_friendly_name, structure):
 
-        for entity in entities:
+    if "name" not in root_burner_structure[cloud]:
+        build_burner_root_structure(cloud)
 
-            if entity != None:
-                entity_index        = entities.index(entity)
-                entity_type         = matrix[entity_index]["entity_type"]
-                entity_name         = None
-                parent_project_name = None
+    burner_root_wiz_project_name = root_burner_structure[cloud]["name"]
+    burner_folder_name = mg_friendly_name + " Burners"
 
-                if entity_index == 0:
-                    entity_name         = mg_friendly_name
-                    parent_project_name = root_structure[root_wiz_project_name]["name"]
-                else:
-                    # Projects with forward-slashes in name confuse are not accepted. Substitute forward-slashes for dashes
-                    if entity["name"].find("/") != -1:
-                        entity_name = entity["name"].replace("/","-")
-                    else:
-                        entity_name = entity["name"]
+    find_or_create_project_element(burner_root_wiz_project_name, "cloud_organization", burner_folder_name, [burner_folder_name], structure["burner_mg_id"], True, burner_root_wiz_project_name + "/" + burner_folder_name, cloud)
 
-                entity_lineage      = build_entity_lineage(cloud, entity_index, entities, mg_friendly_name)
-                entity_path         = root_wiz_project_name + "/" + "/".join(entity_lineage)
-                entity_external_id  = entity["properties"]["externalId"]
+    build_structure(structure, cloud, burner_folder_name, [], burner_root_wiz_project_name, True)
 
-                if entity_type == "cloud_organization":
+# build_structure()
+# Adds a fetched project structure to the tree: first its own query results, then any
+# partitions it was split into
 
-                    root_structure[root_wiz_project_name] = find_or_create_cloud_org(root_structure[root_wiz_project_name], entity_index, entity_name, entity_lineage, entity_external_id, burner_mode, entity_path, cloud, parent_project_name)
+def build_structure(structure, cloud, root_entity_name, lineage_prefix, root_wiz_project_name, burner_mode):
 
-                elif entity_type == "subscription":
+    seen_edges = set()
+    for page in structure["pages"]:
+        build_project_structure(page, cloud, root_wiz_project_name, root_entity_name, lineage_prefix, burner_mode, seen_edges)
 
-                    root_structure[root_wiz_project_name] = find_or_create_subscription(root_structure[root_wiz_project_name], entity_index, entity_name, entity_lineage, entity_external_id, burner_mode, entity_path, cloud, parent_project_name)
+    if structure["partition"] is not None:
+        build_partitioned_structure(structure["partition"], cloud, root_entity_name, lineage_prefix, root_wiz_project_name, burner_mode)
+
+# build_partitioned_structure()
+# Adds a partitioned fetch to the tree: the direct children in listing order, then each child
+# management group's sub-query results in the same order
+
+def build_partitioned_structure(partition, cloud, root_entity_name, lineage_prefix, root_wiz_project_name, burner_mode):
+
+    child_lineage_prefix = lineage_prefix + [root_entity_name]
+
+    for child in partition["children"]:
+
+        child_name          = child["name"].replace("/","-")
+        child_lineage       = child_lineage_prefix + [child_name]
+        child_path          = root_wiz_project_name + "/" + "/".join(child_lineage)
+        child_external_id   = child["properties"]["externalId"]
+        child_type          = "cloud_organization" if child["type"] == "CLOUD_ORGANIZATION" else "subscription"
+
+        find_or_create_project_element(root_wiz_project_name, child_type, child_name, child_lineage, child_external_id, burner_mode, child_path, cloud)
+
+    child_orgs = [child for child in partition["children"] if child["type"] == "CLOUD_ORGANIZATION"]
+
+    for child, structure in zip(child_orgs, partition["partitions"]):
+        build_structure(structure, cloud, child["name"].replace("/","-"), child_lineage_prefix, root_wiz_project_name, burner_mode)
+
+# build_project_structure()
+# Adds the entities from one page of graphSearch results to the project tree. The query's
+# root entity is named root_entity_name, and lineage_prefix holds the names of any
+# entities above it.
+
+def build_project_structure(results, cloud, root_wiz_project_name, root_entity_name, lineage_prefix, burner_mode, seen_edges):
+
+    matrix = get_matrix(cloud)
+
+    unique_entities = collect_unique_entities(results, cloud, seen_edges)
+
+    logging.info(str(len(unique_entities)) + " unique entities to process")
+
+    for (entity_index, entities) in unique_entities:
+
+        entity              = entities[entity_index]
+        entity_type         = matrix[entity_index]["entity_type"]
+        entity_name         = None
+
+        if entity_index == 0:
+            entity_name         = root_entity_name
+        else:
+            # Projects with forward-slashes in name confuse are not accepted. Substitute forward-slashes for dashes
+            if entity["name"].find("/") != -1:
+                entity_name = entity["name"].replace("/","-")
+            else:
+                entity_name = entity["name"]
+
+        entity_lineage      = lineage_prefix + build_entity_lineage(cloud, entity_index, entities, root_entity_name)
+        entity_path         = root_wiz_project_name + "/" + "/".join(entity_lineage)
+        entity_external_id  = entity["properties"]["externalId"]
+
+        find_or_create_project_element(root_wiz_project_name, entity_type, entity_name, entity_lineage, entity_external_id, burner_mode, entity_path, cloud)
 
 # write_to_project_file()
 # Writes a line representing this project/folder project to the project output file CSV
@@ -503,33 +768,74 @@ def write_to_project_file(project_name, external_id, full_path, is_folder, paren
 
     path_depth = len(full_path.split("/"))
 
-    f = open(project_output_file, "a")
-
     if parent_project_name == None:
-        f.write("\"" + project_name + "\",\"" + str(is_folder)  + "\",\"" + str(external_id) + "\",,,\"" + full_path + "\",\"" + str(path_depth) + "\",\"" + cloud +"\"\n")
-    else:
-        f.write("\"" + project_name + "\",\"" + str(is_folder)  + "\",\"" + str(external_id) + "\",,\"" + parent_project_name + "\",\"" + full_path + "\",\"" + str(path_depth) + "\",\"" + cloud +"\"\n")
+        parent_project_name = ""
+
+    project_output_writer.writerow([project_name, str(is_folder), str(external_id), "", parent_project_name, full_path, str(path_depth), cloud])
+
+# Output files are opened once and written through a buffer of this size
+OUTPUT_FILE_BUFFER_SIZE = 1024 * 1024
+
+# Output file handles and their CSV writers, set up by initialise_mock_files()
+project_output_handle   = None
+project_output_writer   = None
+ad_output_handle        = None
+ad_output_writer        = None
+
+# open_output_file()
+# Truncates an output file, writes its header row and returns the open handle with a CSV writer over it
+
+def open_output_file(filename, header):
 
+    f = open(filename, "w", newline="", buffering=OUTPUT_FILE_BUFFER_SIZE)
+    f.write(header)
+
+    return f, csv.writer(f, quoting=csv.QUOTE_ALL, lineterminator="\n")
 
 def initialise_mock_files():
-    g = open(project_output_file,"w")
-    g.write("wiz-project-name,isFolder,cloudAccountLinks,cloudOrganizationLinks,parentProjectName,Full Path,Path Depth,Cloud\n")
 
-    g = open(ad_output_file,"w")
-    g.write("Group Name,Wiz Project,Member Name,Member UPN/Email,Originating Cloud\n")
+    global project_output_handle, project_output_writer, ad_output_handle, ad_output_writer
+
+    project_output_handle, project_output_writer = open_output_file(project_output_file, "wiz-project-name,isFolder,cloudAccountLinks,cloudOrganizationLinks,parentProjectName,Full Path,Path Depth,Cloud\n")
+    ad_output_handle, ad_output_writer = open_output_file(ad_output_file, "Group Name,Wiz Project,Member Name,Member UPN/Email,Originating Cloud\n")
+
+    atexit.register(close_output_files)
+
+# close_output_files()
+# Flushes and closes the output files. Safe to call more than once.
+
+def close_output_files():
 
+    for f in [project_output_handle, ad_output_handle]:
+        if f != None and not f.closed:
+            f.close()
 
-def loop_model_project_structure(burner_mode, cloud, root_mg_list):
+
+def get_root_jobs(burner_mode, cloud, root_mg_list):
 
     mg_list = json.loads(root_mg_list)
 
-    for mg in mg_list:
+    return [(burner_mode, mg["group_id"], cloud, mg["friendly_name"], mg["burner_list"]) for mg in mg_list]
+
+# loop_model_project_structure()
+# Fetches every root management group concurrently, and adds them to the tree in the order
+# given so project codes don't depend on which query finishes first. The earliest unbuilt
+# root is built page by page as its results arrive; roots that finish ahead of it are held
+# until it is done.
+
+def loop_model_project_structure(root_jobs):
+
+    seen_edges = set()
+
+    for (args, kind, value) in ctwiz.iter_concurrently_in_order(fetch_root_project_structure, root_jobs, ROOT_FETCH_CONCURRENCY):
 
-        mg_friendly_name = mg["friendly_name"]
-        mg_id = mg["group_id"]
-        mg_burner_list = mg["burner_list"]
+        (burner_mode, mg_id, cloud, mg_friendly_name, mg_burner_list) = args
 
-        model_project_structure(burner_mode, mg_id, cloud, mg_friendly_name, mg_burner_list)
+        if kind == "item":
+            build_project_structure(value, cloud, get_root_wiz_project_name(cloud), mg_friendly_name, [], burner_mode, seen_edges)
+        else:
+            model_project_structure(burner_mode, cloud, mg_friendly_name, value)
+            seen_edges = set()
 
 
 def main():
@@ -544,15 +850,21 @@ def main():
 
     logging.info("Modelling project structure...")
     build_root_structure()
-    loop_model_project_structure(False, "Azure", azure_root_management_group_list)
-    loop_model_project_structure(False, "GCP", gcp_root_org_list)
-    loop_model_project_structure(False, "AWS", aws_root_org_list)
-
-    # Might just skip burners all together. They can always be added manually later on.
-    #logging.info("Modelling project structure (burners)...")
-    #loop_model_project_structure(True, "Azure", azure_root_management_group_list)
-    # Skip GCP burners for now- too many results appears to be the problem here.
-    #model_project_structure(True, gcp_organization_id, "GCP")
+
+    # Burner management groups are modelled after all the other roots
+    root_jobs = get_root_jobs(False, "Azure", azure_root_management_group_list)
+    root_jobs = root_jobs + get_root_jobs(False, "GCP", gcp_root_org_list)
+    root_jobs = root_jobs + get_root_jobs(False, "AWS", aws_root_org_list)
+    root_jobs = root_jobs + get_root_jobs(True, "Azure", azure_root_management_group_list)
+    root_jobs = root_jobs + get_root_jobs(True, "GCP", gcp_root_org_list)
+
+    loop_model_project_structure(root_jobs)
+
+    logging.info("Fetching group members...")
+    fetch_pending_group_members()
+
+    close_output_files()
+    ctwiz.close_wiz_session()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
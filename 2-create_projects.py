@@ -5,6 +5,9 @@
 
 # Python 3.6+
 # pip install gql==3.0.0a5 aiohttp==3.7.3
+import asyncio
+import atexit
+import copy
 import http.client
 import json
 import csv
@@ -12,6 +15,7 @@ import os
 import sys
 from gql import gql, Client
 from gql.transport.aiohttp import AIOHTTPTransport
+from gql.transport.exceptions import TransportQueryError
 
 ARG_CLIENT_ID                   = 1
 ARG_CLIENT_SECRET               = 2
@@ -40,16 +44,46 @@ elif enable_write_mode == "false":
 api_endpoint = "https://api." + wiz_datacenter + ".app.wiz.io/graphql"
 auth_endpoint = "auth.app.wiz.io"
 
-def checkAPIerrors(query, variables, access_token):
-    transport = AIOHTTPTransport(
-        url=api_endpoint,
-        headers={'Authorization': 'Bearer ' + access_token}
-    )
-    client = Client(transport=transport, fetch_schema_from_transport=False,
-                    execute_timeout=55)
+# Long-lived gql client shared by every API call in this run. The client is
+# connected lazily on first use and closed by close_gql_session().
+gql_loop    = None
+gql_client  = None
+gql_session = None
+
+def get_gql_session(access_token):
+    """Return the shared gql session, connecting it on first use"""
+    global gql_loop, gql_client, gql_session
+
+    if gql_session is None:
+        transport = AIOHTTPTransport(
+            url=api_endpoint,
+            headers={'Authorization': 'Bearer ' + access_token}
+        )
+        gql_client = Client(transport=transport, fetch_schema_from_transport=False,
+                            execute_timeout=55)
+        gql_loop = asyncio.new_event_loop()
+        gql_session = gql_loop.run_until_complete(gql_client.connect_async())
+
+    return gql_session
+
+def close_gql_session():
+    """Close the shared gql session and its event loop, if open"""
+    global gql_loop, gql_client, gql_session
+
+    if gql_session is not None:
+        gql_loop.run_until_complete(gql_client.close_async())
+        gql_loop.close()
+        gql_loop    = None
+        gql_client  = None
+        gql_session = None
+
+atexit.register(close_gql_session)
+
+async def checkAPIerrorsAsync(query, variables, access_token):
+    session = get_gql_session(access_token)
 
     try:
-        result = client.execute(query, variable_values=variables)
+        result = await session.execute(query, variable_values=variables)
     except Exception as e:
         if ('502: Bad Gateway' not in str(e)
            and '503: Service Unavailable' not in str(e)):
@@ -59,15 +93,12 @@ def checkAPIerrors(query, variables, access_token):
             print("Retry")
     return result
 
-createProject_query = gql("""
-  mutation CreateProject($input: CreateProjectInput!) {
-      createProject(input: $input) {
-        project {
-          id
-        }
-      }
-    }
-""")
+def checkAPIerrors(query, variables, access_token):
+    # Connect before entering the loop, as connecting runs the loop itself
+    get_gql_session(access_token)
+
+    return gql_loop.run_until_complete(
+        checkAPIerrorsAsync(query, variables, access_token))
 
 createFolderProject_variables = {
   'input': {
@@ -130,19 +161,14 @@ cloudAccount_query = gql("""
           externalId
           cloudProvider
         }
+        pageInfo {
+          hasNextPage
+          endCursor
+        }
       }
     }
 """)
 
-cloudAccount_variables = {
-  'first': 20,
-  'filterBy': {
-    'search': [
-      ''
-    ]
-  }
-}
-
 cloudOrganization_query = gql("""
   query CloudOrganizations(
       $filterBy: CloudOrganizationFilters
@@ -156,18 +182,85 @@ cloudOrganization_query = gql("""
           externalId
           cloudProvider
         }
+        pageInfo {
+          hasNextPage
+          endCursor
+        }
       }
     }
 """)
 
-cloudOrganization_variables = {
-  'first': 20,
-  'filterBy': {
-    'search': [
-      ''
-    ]
-  }
-}
+# Number of cloud accounts / cloud organizations fetched per page when indexing them
+CLOUD_OBJECT_PAGE_SIZE = 500
+
+# externalId -> Wiz id indexes of every cloud account and cloud organization,
+# loaded once by load_cloud_object_indexes()
+cloud_account_index      = {}
+cloud_organization_index = {}
+
+projects_query = gql("""
+    query ProjectsTable(
+        $filterBy: ProjectFilters
+        $first: Int
+        $after: String
+        $orderBy: ProjectOrder
+    ) {
+        projects(
+        filterBy: $filterBy
+        first: $first
+        after: $after
+        orderBy: $orderBy
+        ) {
+        nodes {
+            id
+            name
+            cloudAccountLinks{
+                cloudAccount {
+                    id
+                    externalId
+                }
+                shared
+                environment
+                resourceGroups
+                resourceTags{
+                    key
+                    value
+                }
+            }
+            cloudOrganizationLinks{
+                cloudOrganization {
+                    id
+                    externalId
+                }
+                shared
+                environment
+                resourceGroups
+                resourceTags{
+                    key
+                    value
+                }
+            }
+            ancestorProjects {
+                id
+            }
+            isFolder
+        }
+        pageInfo {
+            hasNextPage
+            endCursor
+        }
+        }
+    }
+    """)
+
+# Number of projects fetched per page when loading the project registry
+PROJECT_PAGE_SIZE = 500
+
+# (name, isFolder) -> project, for every project in Wiz. Loaded once by
+# load_project_registry() and added to as this run creates projects, so
+# projects and parent folders are resolved without calling the API.
+project_registry = {}
+project_registry_by_id = {}
 
 def write_to_output_file(project_name, project_id, is_folder):
     
@@ -175,210 +268,569 @@ def write_to_output_file(project_name, project_id, is_folder):
     f.write("\"" + project_id + "\",\"" + project_name + "\",\"" + is_folder + "\"\n")
 
 
-def createProject(access_token, query, variables):
+# Maximum number of createProject / updateProject operations sent in one
+# request. Keep this within the API's query size and complexity limits.
+MUTATION_BATCH_SIZE = 20
+
+# Maximum number of mutation requests in flight at once
+MUTATION_CONCURRENCY = 8
+
+# Number of times the updateProject operations of a batch are resent after a
+# transport-level error, such as a timeout or a dropped connection, and the
+# delay in seconds before the first resend. The delay doubles on each further
+# resend.
+MUTATION_RETRIES = 3
+MUTATION_RETRY_DELAY = 2
+
+# Input type of each mutation field that can be batched
+MUTATION_INPUT_TYPES = {
+    'createProject': 'CreateProjectInput',
+    'updateProject': 'UpdateProjectInput'
+}
+
+# Mutations waiting to be sent, as (field, input, future) tuples
+pending_mutations = []
+mutation_flush_scheduled = False
+mutation_semaphore = None
+
+async def executeMutation(access_token, field, input):
+    """Queue one createProject or updateProject operation to be sent in a
+    batch, and return its result in the same shape as a single mutation"""
+    global mutation_flush_scheduled
+
+    future = gql_loop.create_future()
+    pending_mutations.append((field, input, future))
+
+    if len(pending_mutations) >= MUTATION_BATCH_SIZE:
+        flushMutations(access_token)
+    elif not mutation_flush_scheduled:
+        # Flush once every row that is ready to run has queued its mutation
+        mutation_flush_scheduled = True
+        gql_loop.call_soon(flushMutations, access_token)
+
+    return await future
+
+def flushMutations(access_token):
+    """Send every queued mutation, MUTATION_BATCH_SIZE per request"""
+    global mutation_flush_scheduled
+
+    mutation_flush_scheduled = False
+
+    while len(pending_mutations) > 0:
+        batch = pending_mutations[:MUTATION_BATCH_SIZE]
+        del pending_mutations[:MUTATION_BATCH_SIZE]
+        gql_loop.create_task(sendMutationBatch(access_token, batch))
+
+def buildMutationBatch(batch):
+    """Build one mutation document holding every operation in the batch,
+    each under its own alias and input variable"""
+    params = []
+    fields = []
+    variables = {}
+
+    for index, (field, input, future) in enumerate(batch):
+        params.append(f"$input{index}: {MUTATION_INPUT_TYPES[field]}!")
+        fields.append(f"    op{index}: {field}(input: $input{index}) {{\n      project {{\n        id\n      }}\n    }}")
+        variables[f"input{index}"] = input
+
+    query = gql("mutation BatchMutation(" + ", ".join(params) + ") {\n" + "\n".join(fields) + "\n  }")
+
+    return query, variables
+
+async def sendMutationBatch(access_token, batch):
+    """Send a batch of mutations and resolve each operation's future with its
+    own result, or with the error reported for it"""
+    global mutation_semaphore
+
+    if mutation_semaphore is None:
+        mutation_semaphore = asyncio.Semaphore(MUTATION_CONCURRENCY)
+
+    query, variables = buildMutationBatch(batch)
+    session = get_gql_session(access_token)
+
+    data = {}
+    errors = {}
+    attempt = 0
+
+    while True:
+        async with mutation_semaphore:
+            try:
+                data = await session.execute(query, variable_values=variables)
+                break
+            except TransportQueryError as e:
+                # Errors are reported against the alias of the operation that failed
+                data = e.data or {}
+                for error in e.errors or []:
+                    path = error.get('path') or [None]
+                    errors.setdefault(path[0], []).append(error)
+                break
+            except Exception as e:
+                # The server may have applied the batch before the error, so
+                # only updateProject operations, which can safely be applied
+                # twice, are resent. createProject operations fail here
+                # rather than risk creating the same project twice.
+                retry_batch = []
+                if attempt < MUTATION_RETRIES:
+                    retry_batch = [(field, input, future) for (field, input, future) in batch if field == 'updateProject']
+
+                if len(retry_batch) < len(batch):
+                    print("<p>Wiz-API-Error: %s</p>" % str(e))
+                    for (field, input, future) in batch:
+                        if field != 'updateProject' or len(retry_batch) == 0:
+                            future.set_result(e)
+
+                if len(retry_batch) == 0:
+                    return
+
+        # Back off outside the semaphore so other batches can still be sent
+        print("Retry")
+        await asyncio.sleep(MUTATION_RETRY_DELAY * 2 ** attempt)
+        attempt = attempt + 1
+
+        if len(retry_batch) < len(batch):
+            batch = retry_batch
+            query, variables = buildMutationBatch(batch)
+
+    for index, (field, input, future) in enumerate(batch):
+        alias = f"op{index}"
+
+        if alias in errors or data.get(alias) is None:
+            error = TransportQueryError(str(errors.get(alias) or errors.get(None)),
+                                        errors=errors.get(alias) or errors.get(None))
+            print("<p>Wiz-API-Error for \"%s\": %s</p>" % (input.get('name', input.get('id')), str(error)))
+            future.set_result(error)
+        else:
+            future.set_result({field: data[alias]})
+
+async def createProject(access_token, variables):
     """Query WIZ API for the given query data schema"""
 
     result = None
 
     if enable_write_mode == True:
-        result = checkAPIerrors(query, variables, access_token)
+        result = await executeMutation(access_token, 'createProject', variables['input'])
     else:
         print("Skipping creation of this project as write mode is disabled.")
 
     return result
 
-def getCloudObjectDetails(access_token, query, variables):
-    """Query WIZ API for the given query data schema"""
-    result = checkAPIerrors(query, variables, access_token)
+def getCloudObjectIndex(access_token, query, connection):
+    """Page through every cloud account or cloud organization and return an
+    externalId -> Wiz id index of them"""
+    variables = {'first': CLOUD_OBJECT_PAGE_SIZE}
+    index = {}
 
-    return result
+    while True:
+        result = checkAPIerrors(query, variables, access_token)
 
+        for node in result[connection]['nodes']:
+            index[node['externalId']] = node['id']
 
-def getProjectIdFromName(access_token, p_name, is_folder):
-    getProjectsquery = gql("""
-        query ProjectsTable(
-            $filterBy: ProjectFilters
-            $first: Int
-            $after: String
-            $orderBy: ProjectOrder
-        ) {
-            projects(
-            filterBy: $filterBy
-            first: $first
-            after: $after
-            orderBy: $orderBy
-            ) {
-            nodes {
-                id
-                name
-                cloudAccountLinks{
-                    cloudAccount {
-                        id
-                        externalId
-                    }
-                    shared
-                    environment
-                    resourceGroups
-                    resourceTags{
-                        key
-                        value
-                    }
-                }
-                cloudOrganizationLinks{
-                    cloudOrganization {
-                        id
-                        externalId
-                    }
-                    shared
-                    environment
-                    resourceGroups
-                    resourceTags{
-                        key
-                        value
-                    }
-                }
-                ancestorProjects {
-                    id
-                }
-                isFolder
-            }
-            pageInfo {
-                hasNextPage
-                endCursor
-            }
-            totalCount
-            }
-        }
-        """)
-    
-    getProjectsvariables = {
-        "first": 1,
-        "filterBy": {
-            "search": p_name,
-            "isFolder": is_folder
-        },
-        "orderBy": {
-            "field": "NAME",
-            "direction": "ASC"
-        }
-    }
+        if not result[connection]['pageInfo']['hasNextPage']:
+            break
 
-    result = checkAPIerrors(getProjectsquery, getProjectsvariables,
-                            access_token)
+        variables['after'] = result[connection]['pageInfo']['endCursor']
 
-    return result['projects']['nodes'][0]["id"]
+    return index
 
-def getProjects(access_token, p_name, is_folder):
-    getProjectsquery = gql("""
-        query ProjectsTable(
-            $filterBy: ProjectFilters
-            $first: Int
-            $after: String
-            $orderBy: ProjectOrder
-        ) {
-            projects(
-            filterBy: $filterBy
-            first: $first
-            after: $after
-            orderBy: $orderBy
-            ) {
-            nodes {
-                id
-                name
-                cloudAccountLinks{
-                    cloudAccount {
-                        id
-                        externalId
-                    }
-                    shared
-                    environment
-                    resourceGroups
-                    resourceTags{
-                        key
-                        value
-                    }
-                }
-                cloudOrganizationLinks{
-                    cloudOrganization {
-                        id
-                        externalId
-                    }
-                    shared
-                    environment
-                    resourceGroups
-                    resourceTags{
-                        key
-                        value
-                    }
-                }
-                ancestorProjects {
-                    id
-                }
-                isFolder
-            }
-            pageInfo {
-                hasNextPage
-                endCursor
-            }
-            totalCount
-            }
-        }
-        """)
-    
-    getProjectsvariables = {
-        "first": 1,
-        "filterBy": {
-            "search": p_name,
-            "isFolder": is_folder
-        },
+def load_cloud_object_indexes(access_token):
+    global cloud_account_index, cloud_organization_index
+
+    cloud_account_index = getCloudObjectIndex(access_token, cloudAccount_query, 'cloudAccounts')
+    cloud_organization_index = getCloudObjectIndex(access_token, cloudOrganization_query, 'cloudOrganizations')
+
+def getCloudAccountId(external_id):
+    """Return the Wiz id of a cloud account from its external id, or None if
+    it doesn't exist in Wiz"""
+    return cloud_account_index.get(external_id)
+
+def getCloudOrganizationId(external_id):
+    """Return the Wiz id of a cloud organization from its external id, or None
+    if it doesn't exist in Wiz"""
+    return cloud_organization_index.get(external_id)
+
+def getProjectIdFromName(p_name, is_folder):
+    """Return the id of the project with exactly this name, or None if there
+    isn't one"""
+    project = project_registry.get((p_name, is_folder))
+
+    return project["id"] if project else None
+
+def getProjects(p_name, is_folder):
+    """Return a list holding the project with exactly this name, or an empty
+    list if there isn't one"""
+    project = project_registry.get((p_name, is_folder))
+
+    return [project] if project else []
+
+def register_project(project):
+    """Add a project to the registry, keeping the first project seen with a
+    given name"""
+    key = (project["name"], project["isFolder"])
+
+    if key not in project_registry:
+        project_registry[key] = project
+
+    project_registry_by_id[project["id"]] = project
+
+def register_created_project(project_id, p_name, is_folder, cal, col, parent_name):
+    """Add a project created by this run to the registry, in the same shape as
+    the projects loaded by load_project_registry()"""
+    ancestors = []
+    parent = project_registry.get((parent_name, True))
+
+    if parent:
+        ancestors = [{"id": parent["id"]}] + (parent["ancestorProjects"] or [])
+
+    register_project({
+        "id": project_id,
+        "name": p_name,
+        "isFolder": is_folder,
+        "cloudAccountLinks": [{"cloudAccount": {"id": link["cloudAccount"]}, "environment": link["environment"], "shared": link["shared"]} for link in cal],
+        "cloudOrganizationLinks": [{"cloudOrganization": {"id": link["cloudOrganization"]}, "environment": link["environment"], "shared": link["shared"]} for link in col],
+        "ancestorProjects": ancestors
+    })
+
+def load_project_registry(access_token):
+    """Page through every existing project and add it to the registry"""
+    variables = {
+        "first": PROJECT_PAGE_SIZE,
         "orderBy": {
             "field": "NAME",
             "direction": "ASC"
         }
     }
 
-    result = checkAPIerrors(getProjectsquery, getProjectsvariables,
-                            access_token)
+    while True:
+        result = checkAPIerrors(projects_query, variables, access_token)
 
-    return result['projects']['nodes']
+        for project in result['projects']['nodes']:
+            register_project(project)
 
-def mutateProject(access_token, p, input, is_cloud_org=False, patch_parent=False):
-    query = gql("""
-    mutation UpdateProject($input: UpdateProjectInput!) {
-        updateProject(input: $input) {
-            project {
-                id
-            }
-        }
-        }
-    """)
+        if not result['projects']['pageInfo']['hasNextPage']:
+            break
+
+        variables['after'] = result['projects']['pageInfo']['endCursor']
 
+async def mutateProject(access_token, p, patch):
     variables = {
         'input': {
             'id': p,
-            'patch': {
-            }
+            'patch': patch
         }
     }
 
-    if patch_parent:
-        variables['input']['patch']['parentProjectId'] = input
-    elif is_cloud_org:
-        variables['input']['patch']['cloudOrganizationLinks'] = input
-    else:
-        variables['input']['patch']['cloudAccountLinks'] = input
-
     result = None
 
     if enable_write_mode == True:
-        result = checkAPIerrors(query, variables, access_token)
+        result = await executeMutation(access_token, 'updateProject', variables['input'])
     else:
         print("Skipping creation of this project as write mode is disabled.")
 
+    return result
 
+def getCurrentParentName(current):
+    """Return the name of an existing project's parent folder, or None if it
+    has no parent. The parent is the deepest of the project's ancestors"""
+    ancestors = [project_registry_by_id[ancestor['id']] for ancestor in (current['ancestorProjects'] or [])
+                 if ancestor['id'] in project_registry_by_id]
+
+    if not ancestors:
+        return None
+
+    return max(ancestors, key=lambda ancestor: len(ancestor['ancestorProjects'] or []))['name']
+
+def planLinks(current_links, field, external_ids, getWizId, kind):
+    """Return the links one link field should hold, in updateProject input
+    form, and the external ids that are newly linked. Existing links are
+    kept, and a link is added for every listed external id not yet linked"""
+    links = [dict(link, **{field: link[field]['id']}) for link in (current_links or [])]
+    linked_ids = set(link[field] for link in links)
+    added = []
+
+    for external_id in external_ids:
+        wiz_id = getWizId(external_id)
+
+        if not wiz_id:
+            print(f">>>>>>> {kind} {external_id} doesn\'t exist",
+                "in Wiz yet.",
+                "Skipping adding it to the computed list.",
+                "Please check and rectify later! <<<<<<<\n")
+        elif wiz_id not in linked_ids:
+            links.append({field: wiz_id, 'environment': 'PRODUCTION', 'shared': False})
+            linked_ids.add(wiz_id)
+            added.append(external_id)
+
+    return links, added
+
+def planProject(project, update_existing_projects):
+    """Compare one row of the input file with the project registry and return
+    the operation needed to bring Wiz in line with it. Existing projects get
+    a single patch holding every field that differs"""
+    isFolder = project[1].lower() == "true"
+    project_list = getProjects(project[0], isFolder)
+
+    entry = {
+        'row': project,
+        'project': project_list[0] if project_list else None,
+        'patch': {},
+        'changes': []
+    }
 
+    if not project_list:
+        entry['action'] = 'create'
+        return entry
 
-    return result
+    if not update_existing_projects:
+        entry['action'] = 'skip'
+        return entry
+
+    current = project_list[0]
+
+    accounts = project[2].split(",") if len(project[2]) > 0 else []
+    cal, added = planLinks(current['cloudAccountLinks'], 'cloudAccount', accounts, getCloudAccountId, "Account")
+
+    if added:
+        entry['patch']['cloudAccountLinks'] = cal
+        entry['changes'].append("cloudAccountLinks +[" + ",".join(added) + "]")
+
+    orgs = project[3].split(",") if len(project[3]) > 0 else []
+    col, added = planLinks(current['cloudOrganizationLinks'], 'cloudOrganization', orgs, getCloudOrganizationId, "Cloud Organization")
+
+    if added:
+        entry['patch']['cloudOrganizationLinks'] = col
+        entry['changes'].append("cloudOrganizationLinks +[" + ",".join(added) + "]")
+
+    # The new parent is resolved to an id when the plan is applied, as it may
+    # be a folder this run creates
+    parent_name = project[4] if len(project[4]) > 0 else None
+    current_parent_name = getCurrentParentName(current)
+
+    if parent_name != current_parent_name:
+        entry['parent_name'] = parent_name
+        entry['changes'].append(f"parentProject \"{current_parent_name or ''}\" -> \"{parent_name or ''}\"")
+
+    entry['action'] = 'update' if entry['changes'] else 'unchanged'
+
+    return entry
+
+def planProjects(projects_input, update_existing_projects):
+    return [planProject(project, update_existing_projects) for project in projects_input]
+
+def printPlan(plan):
+    print("\nPlan:\n")
+
+    for entry in plan:
+        project = entry['row']
+
+        if entry['action'] == 'create':
+            print(f"  + create \"{project[0]}\" (isFolder: {project[1]},",
+                f"parent folder: \"{project[4]}\", accounts: [{project[2]}],",
+                f"cloud organizations: [{project[3]}])")
+        elif entry['action'] == 'update':
+            print(f"  ~ update \"{project[0]}\": " + "; ".join(entry['changes']))
+
+    actions = [entry['action'] for entry in plan]
+
+    print(f"\n{actions.count('create')} to create, {actions.count('update')} to update,",
+        f"{actions.count('unchanged')} unchanged, {actions.count('skip')} existing",
+        "not updated.\n")
+
+async def createNewProject(token, project):
+    """Create the project described by one row of the input file"""
+
+    cal = []
+    col = []
+
+    print(f"Creating Project \"{project[0]}\" with",
+        f"\nisFolder: [{project[1]}]", 
+        f"\naccounts: [{project[2]}]", 
+        f"\ncloud organizations:[{project[3]}]"
+        f"\nparent folder name: \"{project[4]}\" \n")
+
+    accounts = project[2].split(",") if len(project[2]) > 0 else []
+    for account in accounts:
+
+        # fetch Wiz GUID of the subscription ID from the input
+        wiz_account_id = getCloudAccountId(account)
+
+        if wiz_account_id:
+            cal.append({'cloudAccount': wiz_account_id,
+                        'environment': 'PRODUCTION', 'shared': False})
+        else:
+            print(f">>>>>>> Account {account} doesn\'t exist in Wiz yet.",
+                "Skipping adding it to the computed list. Please check",
+                "and rectify later! <<<<<<<\n")
+
+    orgs = project[3].split(",") if len(project[3]) > 0 else []
+    for org in orgs:
+
+        # fetch Wiz GUID of the subscription ID from the input
+        wiz_org_id = getCloudOrganizationId(org)
+
+        if wiz_org_id:
+            col.append({'cloudOrganization': wiz_org_id,
+                        'environment': 'PRODUCTION', 'shared': False})
+        else:
+            print(f">>>>>>> Cloud Organization {org} doesn\'t exist in Wiz yet.",
+                "Skipping adding it to the computed list. Please check",
+                "and rectify later! <<<<<<<\n")
+            
+    createProject_response = None
+
+    isFolder = None
+
+    if project[1].lower() == "true":
+        isFolder = True
+    elif project[1].lower() == "false":
+        isFolder = False
+
+    parentProjectId = None
+        
+    if len(project[4]) > 0:
+        # Parent Project ID must be a folder, so hardcoding True here
+        parentProjectId = getProjectIdFromName(project[4], True)
+
+        if parentProjectId:
+            print(f"\nfound parent project id: \"" + parentProjectId + "\" \n")
+        else:
+            print(f">>>>>>> Parent folder \"{project[4]}\" doesn\'t exist in Wiz.",
+                "Creating the project without a parent. Please check",
+                "and rectify later! <<<<<<<\n")
+
+    # If this is a folder project
+    if isFolder == True:
+
+        variables = copy.deepcopy(createFolderProject_variables)
+        variables['input']['name'] = project[0]
+        variables['input']['isFolder'] = isFolder
+        variables['input']['parentProjectId'] = parentProjectId if parentProjectId else None
+        createProject_response = await createProject(token, variables)
+    
+    elif isFolder == False:
+
+        variables = copy.deepcopy(createProject_variables)
+        variables['input']['name'] = project[0]
+        variables['input']['isFolder'] = isFolder
+        variables['input']['cloudAccountLinks'] = cal
+        variables['input']['cloudOrganizationLinks'] = col
+        variables['input']['parentProjectId'] = parentProjectId if parentProjectId else None
+        createProject_response = await createProject(token, variables)
+
+
+    if isinstance(createProject_response, Exception):
+        print(f">>>>>>> Failed to create Project \"{project[0]}\".",
+            "Please check and rectify later! <<<<<<<\n")
+        return
+
+    print(f"Created Project \"{project[0]}\". Successful creation output",
+    f" and Project ID:\n{createProject_response}")
+
+    projectId = createProject_response["createProject"]["project"]["id"]
+
+    register_created_project(projectId, project[0], isFolder,
+                             cal if isFolder == False else [],
+                             col if isFolder == False else [],
+                             project[4])
+
+    write_to_output_file(project[0], projectId, project[1])
+    
+    print("\nConsider editing the newly created project and tweaking its",
+    "settings.\ne.g., description, risk profiile, regulatory",
+    "standards, etc.")
+
+async def updateExistingProject(token, entry):
+    """Apply an existing project's planned changes with one updateProject"""
+
+    project = entry['row']
+    current = entry['project']
+    patch = dict(entry['patch'])
+
+    if 'parent_name' in entry:
+        parentProjectId = None
+
+        if entry['parent_name']:
+            # Parent Project ID must be a folder, so hardcoding True here
+            parentProjectId = getProjectIdFromName(entry['parent_name'], True)
+
+        if entry['parent_name'] and not parentProjectId:
+            print(f">>>>>>> Parent folder \"{entry['parent_name']}\" doesn\'t exist in Wiz.",
+                "Leaving the parentProject unchanged. Please check",
+                "and rectify later! <<<<<<<\n")
+        else:
+            patch['parentProjectId'] = parentProjectId
+
+    if patch:
+        result = await mutateProject(token, current['id'], patch)
+
+        if isinstance(result, Exception):
+            print(f">>>>>>> Failed to update Project \"{project[0]}\".",
+                "Please check and rectify later! <<<<<<<\n")
+            return
+
+        print(f">>>>>>> Updated Project \"{project[0]}\": " + "; ".join(entry['changes']))
+
+    write_to_output_file(current["name"], current["id"], str(current["isFolder"]))
+
+async def applyPlanEntry(token, entry):
+    project = entry['row']
+
+    if entry['action'] == 'create':
+        await createNewProject(token, project)
+    elif entry['action'] == 'update':
+        await updateExistingProject(token, entry)
+    elif entry['action'] == 'unchanged':
+        print(f"No changes to apply to Project \"{project[0]}\".")
+        write_to_output_file(entry['project']["name"], entry['project']["id"], str(entry['project']["isFolder"]))
+    else:
+        print(f"Not updating Project \"{project[0]}\",",
+            "based on your acknowledgement in the beginning",
+            "of this script.")
+
+def getProjectDepths(projects_input):
+    """Return the depth of every row of the input file. This is the row's Path
+    Depth column where present, otherwise one more than its parent's depth"""
+    rows_by_name = {}
+    for project in projects_input:
+        rows_by_name.setdefault(project[0], project)
+
+    depths = {}
+
+    def depth_of(project):
+        key = id(project)
+        if key not in depths:
+            if len(project) > 6 and project[6].strip().isdigit():
+                depths[key] = int(project[6])
+            else:
+                parent = rows_by_name.get(project[4]) if len(project[4]) > 0 else None
+                depths[key] = depth_of(parent) + 1 if parent and parent is not project else 1
+        return depths[key]
+
+    return [depth_of(project) for project in projects_input]
+
+def groupPlanByDepth(plan):
+    """Group the plan's entries by the depth of their row, shallowest first. A
+    parent is always shallower than its children, so every row's parent has
+    been created by the time its depth is reached"""
+    levels = {}
+    for entry, depth in zip(plan, getProjectDepths([entry['row'] for entry in plan])):
+        levels.setdefault(depth, []).append(entry)
+
+    return [levels[depth] for depth in sorted(levels)]
+
+async def applyPlanEntriesConcurrently(token, entries):
+    # Request concurrency is bounded by the mutation batching, so every entry
+    # at this depth is started at once and its mutations share batches
+    await asyncio.gather(*[applyPlanEntry(token, entry) for entry in entries])
+
+def applyPlan(token, plan):
+    """Apply the plan one depth at a time. All entries at the same depth are
+    applied concurrently, with their mutations sent in batches. Unchanged
+    projects make no API calls"""
+    get_gql_session(token)
+
+    for entries in groupPlanByDepth(plan):
+        gql_loop.run_until_complete(applyPlanEntriesConcurrently(token, entries))
 
 def request_wiz_api_token(client_id, client_secret):
     """Retrieve an OAuth access token to be used against Wiz API"""
@@ -429,6 +881,12 @@ if __name__ == "__main__":
         reader = csv.reader(f, delimiter=',')
         projects_input_from_file = list(reader)
 
+    print("\nIndexing cloud accounts and cloud organizations...")
+    load_cloud_object_indexes(token)
+
+    print("Loading existing Projects...")
+    load_project_registry(token)
+
     print("\nStart to create Projects with the associated",
         "Subscriptions, Cloud Organizations, and Parent Folders"
         " from the input file\n")
@@ -449,255 +907,12 @@ if __name__ == "__main__":
         print("Per user input, we\'ll also update existing Projects.")
         update_existing_projects = True
 
-    for project in projects_input_from_file:
-
-        isFolder = False
-        if project[1].lower() == "true":
-            isFolder = True
-
-        print("########################")
-        print(f"Validating if Project with name \"{project[0]}\" exists.")
-        project_list = getProjects(token, project[0], isFolder)
-
-        cal = []
-        col = []
-        if not project_list:
-
-            print(f"Creating Project \"{project[0]}\" with",
-                f"\nisFolder: [{project[1]}]", 
-                f"\naccounts: [{project[2]}]", 
-                f"\ncloud organizations:[{project[3]}]"
-                f"\nparent folder name: \"{project[4]}\" \n")
-
-            accounts = project[2].split(",") if len(project[2]) > 0 else []
-            for account in accounts:
-
-                # fetch Wiz GUID of the subscription ID from the input
-                cloudAccount_variables['filterBy']['search'] = [account]
-                wiz_account_id = getCloudObjectDetails(token, cloudAccount_query,
-                                                        cloudAccount_variables)
-
-                if wiz_account_id['cloudAccounts']['nodes']:
-                    cal.append({'cloudAccount': wiz_account_id['cloudAccounts']['nodes'][0]['id'],  # noqa: 501
-                                'environment': 'PRODUCTION', 'shared': False})
-                else:
-                    print(f">>>>>>> Account {account} doesn\'t exist in Wiz yet.",
-                        "Skipping adding it to the computed list. Please check",
-                        "and rectify later! <<<<<<<\n")
-        
-            orgs = project[3].split(",") if len(project[3]) > 0 else []
-            for org in orgs:
-
-                # fetch Wiz GUID of the subscription ID from the input
-                cloudOrganization_variables['filterBy']['search'] = [org]
-                wiz_org_id = getCloudObjectDetails(token, cloudOrganization_query,
-                                                        cloudOrganization_variables)
-
-                if wiz_org_id['cloudOrganizations']['nodes']:
-                    col.append({'cloudOrganization': wiz_org_id['cloudOrganizations']['nodes'][0]['id'],  # noqa: 501
-                                'environment': 'PRODUCTION', 'shared': False})
-                else:
-                    print(f">>>>>>> Account {account} doesn\'t exist in Wiz yet.",
-                        "Skipping adding it to the computed list. Please check",
-                        "and rectify later! <<<<<<<\n")
-                    
-            createProject_response = None
-
-            isFolder = None
-
-            if project[1].lower() == "true":
-                isFolder = True
-            elif project[1].lower() == "false":
-                isFolder = False
-
-            parentProjectId = None
-                
-            if len(project[4]) > 0:
-                # Parent Project ID must be a folder, so hardcoding True here
-                parentProjectId = getProjectIdFromName(token, project[4], True)
-                print(f"\nfound parent project id: \"" + parentProjectId + "\" \n")
-
-            # If this is a folder project
-            if isFolder == True:
-
-                createFolderProject_variables['input']['name'] = project[0]
-                createFolderProject_variables['input']['isFolder'] = isFolder
-                createFolderProject_variables['input']['parentProjectId'] = parentProjectId if parentProjectId else None
-                createProject_response = createProject(token, createProject_query,
-                                                    createFolderProject_variables)
-            
-            elif isFolder == False:
-
-                createProject_variables['input']['name'] = project[0]
-                createProject_variables['input']['isFolder'] = isFolder
-                createProject_variables['input']['cloudAccountLinks'] = cal
-                createProject_variables['input']['cloudOrganizationLinks'] = col
-                createProject_variables['input']['parentProjectId'] = parentProjectId if parentProjectId else None
-                createProject_response = createProject(token, createProject_query,
-                                                    createProject_variables)
-
-
-            print(f"Created Project \"{project[0]}\". Successful creation output",
-            f" and Project ID:\n{createProject_response}")
-
-            projectId = createProject_response["createProject"]["project"]["id"]
-
-            write_to_output_file(project[0], projectId, project[1])
-            
-            print("\nConsider editing the newly created project and tweaking its",
-            "settings.\ne.g., description, risk profiile, regulatory",
-            "standards, etc.")
-
-        else:
-            # if projects_list has more than one entry, we had multiple hits on the search name. I couldn't find
-            # a means to filter this in the query, so we'll post process to ensure we're acting on the project with 
-            # the exact same name. Multiple projects with the same names will cause issues
-
-            if project_list and len(project_list) > 1:
-                temp = []
-                for p in project_list:
-                    if p['name'] == project[0]:
-                        temp.append(p)
-                        break
-                project_list = temp
-
-            print("\nProject exists.")
-            if update_existing_projects:
-                print("Based on your acknowledgement in the beginning of this",
-                    f"script,\nUpdating Project \"{project[0]}\" with",
-                    f"\nis folder:[{project[1]}]"
-                    f"\naccounts: [{project[2]}]", 
-                    f"\ncloud organizations:[{project[3]}]"
-                    f"\nparent folder name association: \"{project[4]}\" \n")
-
-                current_project_cal = project_list[0]['cloudAccountLinks']
-                current_project_col = project_list[0]['cloudOrganizationLinks']
-                current_project_ancestors = project_list[0]['ancestorProjects'] if project_list[0]['ancestorProjects'] else None
-
-                # hack to fix output of ['cloudAccount]['cloudAccount'] to
-                # input of ['cloudAccount']
-                cal = current_project_cal
-                for item_current, item_new in zip(current_project_cal, cal):
-                    item_new['cloudAccount'] = item_current['cloudAccount']['id']
-                accounts = project[2].split(",") if len(project[2]) > 0 else []
-
-                apply_mutation = False
-                for account in accounts:
-
-                    account_already_in_cal = False
-                    # fetch Wiz GUID of the subscription ID from the input
-                    cloudAccount_variables['filterBy']['search'] = [account]
-                    wiz_account_id = getCloudObjectDetails(token,
-                                                            cloudAccount_query,
-                                                            cloudAccount_variables)
-
-                    if wiz_account_id['cloudAccounts']['nodes']:
-                        for item in cal:
-                            if item['cloudAccount'] == wiz_account_id['cloudAccounts']['nodes'][0]['id']:  # noqa: 501
-                                account_already_in_cal = True
-                                break
-                            else:
-                                account_already_in_cal = False
-
-                        if not account_already_in_cal:
-                            cal.append({'cloudAccount': wiz_account_id['cloudAccounts']['nodes'][0]['id'],  # noqa: 501
-                                        'environment': 'PRODUCTION',
-                                        'shared': False})
-                            apply_mutation = True
-                    else:
-                        print(f">>>>>>> Account {account} doesn\'t exist",
-                            "in Wiz yet.",
-                            "Skipping adding it to the computed list.",
-                            "Please check and rectify later! <<<<<<<\n")
-                
-                if apply_mutation:
-                    mutateProject(token, project_list[0]['id'], cal, is_cloud_org=False)
-                    print(f">>>>>>> Updated CloudAccountLinks applied.")
-                else:
-                    print(f">>>>>>> No changes to CloudAccountLinks to apply")
-
-                # --------------------------------------------------------------
-
-                apply_mutation = False
-                col = current_project_col
-                for item_current, item_new in zip(current_project_col, col):
-                    item_new['cloudOrganization'] = item_current['cloudOrganization']['id']
-                orgs = project[3].split(",") if len(project[3]) > 0 else []
-
-                for org in orgs:
-                    account_already_in_col = False
-                    # fetch Wiz GUID of the subscription ID from the input
-                    cloudOrganization_variables['filterBy']['search'] = [org]
-                    wiz_account_id = getCloudObjectDetails(token,
-                                                            cloudOrganization_query,
-                                                            cloudOrganization_variables)
-
-                    if wiz_account_id['cloudOrganizations']['nodes']:
-                        for item in col:
-                            if item['cloudOrganization'] == wiz_account_id['cloudOrganizations']['nodes'][0]['id']:  # noqa: 501
-                                account_already_in_col = True
-                                break
-                            else:
-                                account_already_in_col = False
-
-                        if not account_already_in_col:
-                            col.append({'cloudOrganization': wiz_account_id['cloudOrganizations']['nodes'][0]['id'],  # noqa: 501
-                                        'environment': 'PRODUCTION',
-                                        'shared': False})
-                            apply_mutation = True
-
-                    else:
-                        print(f">>>>>>> Cloud Organization {org} doesn\'t exist",
-                            "in Wiz yet.",
-                            "Skipping adding it to the computed list.",
-                            "Please check and rectify later! <<<<<<<\n")
-
-                if apply_mutation:
-                    mutateProject(token, project_list[0]['id'], col, is_cloud_org=True)
-                    print(f">>>>>>> Updated CloudOrganizationLinks applied.")
-                else:
-                    print(f">>>>>>> No changes to CloudOrganizationLinks to apply")
-
-                # --------------------------------------------------------------
-
-                ## Update parent project if needed
-                apply_mutation = False
-                current_project_ancestor = None
-
-                parentProjectId = None
-                
-                if len(project[4]) > 0:
-                    # Parent Project ID must be a folder, so hardcoding True here
-                    parentProjectId = getProjectIdFromName(token, project[4], True)
-                    print(f"\nfound parent project id: \"" + parentProjectId + "\" \n")
-
-                if current_project_ancestors and len(current_project_ancestors) > 1:
-                    found_ancestor = False
-                    for ancestor in current_project_ancestors:
-                        if ancestor == parentProjectId:
-                            found_ancestor = True
-                            print(f">>>>>>> No change to parentProject to apply") 
-                            break
-
-                    if not found_ancestor:
-                        # if we go through the ancestors and don't have a match on parents, we need to update
-                        apply_mutation = True
-                else:
-                    current_project_ancestor = current_project_ancestors[0]['id'] if current_project_ancestors else None
-                    if str(current_project_ancestor or '') != parentProjectId:
-                        apply_mutation = True
-
-                if apply_mutation:
-                    # update parent project
-                    mutateProject(token, project_list[0]['id'], parentProjectId, is_cloud_org=False, patch_parent=True)
-                    print(f">>>>>>> Updated parentProject applied.")
-                else:
-                    print(f">>>>>>> No changes to parentProject applied.")
-
-                write_to_output_file(project_list[0]["name"], project_list[0]["id"], str(project_list[0]["isFolder"]))
+    plan = planProjects(projects_input_from_file, update_existing_projects)
+    printPlan(plan)
 
+    if enable_write_mode == True:
+        applyPlan(token, plan)
+    else:
+        print("Write mode is disabled, so the plan above has not been applied.")
 
-            else:
-                print(f"Not updating Project \"{project[0]}\",",
-                    "based on your acknowledgement in the beginning",
-                    "of this script.")
\ No newline at end of file
+    close_gql_session()
@@ -1,5 +1,7 @@
 # Python 3.6+
 # pip install gql==3.0.0a5 aiohttp==3.7.3
+import asyncio
+import atexit
 import http.client
 import json
 import csv
@@ -134,17 +136,52 @@ patch_saml_variables = {
 }
 
 
+# Long-lived gql client shared by every API call in this run. The client is
+# connected lazily on first use and closed by close_gql_session().
+gql_loop = None
+gql_client = None
+gql_session = None
+
+
+def get_gql_session(access_token):
+    """Return the shared gql session, connecting it on first use"""
+    global gql_loop, gql_client, gql_session
+
+    if gql_session is None:
+        transport = AIOHTTPTransport(
+            url=api_endpoint,
+            headers={'Authorization': 'Bearer ' + access_token}
+        )
+        gql_client = Client(transport=transport,
+                            fetch_schema_from_transport=False,
+                            execute_timeout=55)
+        gql_loop = asyncio.new_event_loop()
+        gql_session = gql_loop.run_until_complete(gql_client.connect_async())
+
+    return gql_session
+
+
+def close_gql_session():
+    """Close the shared gql session and its event loop, if open"""
+    global gql_loop, gql_client, gql_session
+
+    if gql_session is not None:
+        gql_loop.run_until_complete(gql_client.close_async())
+        gql_loop.close()
+        gql_loop = None
+        gql_client = None
+        gql_session = None
+
+
+atexit.register(close_gql_session)
+
+
 def checkAPIerrors(query, variables, access_token):
-    transport = AIOHTTPTransport(
-        url=api_endpoint,
-        headers={'Authorization': 'Bearer ' + access_token}
-    )
-    client = Client(transport=transport,
-                    fetch_schema_from_transport=False,
-                    execute_timeout=55)
+    session = get_gql_session(access_token)
 
     try:
-        result = client.execute(query, variable_values=variables)
+        result = gql_loop.run_until_complete(
+            session.execute(query, variable_values=variables))
     except Exception as e:
         if ('502: Bad Gateway' not in str(e)
            and '503: Service Unavailable' not in str(e)):
@@ -451,6 +488,8 @@ def main():
 
     except Exception as e:
         logging.error('An exception has been raised: {}'.format(e))
+    finally:
+        close_gql_session()
 
 
 if __name__ == '__main__':
@@ -1,32 +1,324 @@
+import concurrent.futures
+import contextlib
 import requests
 import logging
+import queue
+import threading
+import time
+from requests.adapters import HTTPAdapter
 
 # Standard headers
 HEADERS_AUTH = {"Content-Type": "application/x-www-form-urlencoded"}
 HEADERS = {"Content-Type": "application/json"}
 
-def query_wiz_api(query, variables, wiz_dc):
-    """Query Wiz API for the given query data schema"""
-    data = {"variables": variables, "query": query}
+# Connection pool settings for the shared API session. The pool should be at
+# least as large as the number of threads issuing requests concurrently.
+DEFAULT_POOL_CONNECTIONS    = 4
+DEFAULT_POOL_MAXSIZE        = 32
+
+_wiz_session = None
+
+def configure_wiz_session(pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE):
+    """(Re)create the shared keep-alive session used for all Wiz API calls"""
+    global _wiz_session
+
+    session = requests.Session()
+    session.headers.update(HEADERS)
+
+    if _wiz_session is not None:
+        # Carry the Authorization header over to the new session
+        session.headers.update(_wiz_session.headers)
+        _wiz_session.close()
+
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount("https://", adapter)
+
+    # Uncomment the next line to run behind proxies
+    # session.proxies.update(proxyDict)
+
+    _wiz_session = session
+
+    return _wiz_session
+
+def get_wiz_session():
+    """Return the shared Wiz API session, creating it on first use"""
+    if _wiz_session is None:
+        configure_wiz_session()
+
+    return _wiz_session
+
+def close_wiz_session():
+    """Close all pooled connections held by the shared Wiz API session"""
+    global _wiz_session
+
+    if _wiz_session is not None:
+        _wiz_session.close()
+        _wiz_session = None
+
+def run_concurrently(func, args_list, max_concurrency):
+    """Call func once per tuple in args_list from a pool of max_concurrency
+    worker threads. Results are returned in args_list order."""
+
+    if len(args_list) == 0:
+        return []
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency)
+
+    try:
+        futures = [executor.submit(func, *args) for args in args_list]
+
+        return [future.result() for future in futures]
+    finally:
+        # Calls not yet started are dropped if a call raised
+        executor.shutdown(cancel_futures=True)
+
+def iter_concurrently_in_order(func, args_list, max_concurrency):
+    """Call func(emit, *args) once per tuple in args_list from a pool of
+    max_concurrency worker threads, where func may pass items to emit as it
+    produces them.
+
+    Yields (args, "item", item) for each emitted item and then
+    (args, "result", result) for each call, strictly in args_list order. The
+    earliest unfinished call's items are yielded as soon as they're emitted;
+    later calls' items are held until every call before them has finished."""
+
+    if len(args_list) == 0:
+        return
+
+    streams = [queue.Queue() for args in args_list]
+
+    def run_one(stream, args):
+        try:
+            stream.put(("result", func(lambda item: stream.put(("item", item)), *args)))
+        except BaseException as e:
+            stream.put(("error", e))
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency)
+
+    try:
+        for stream, args in zip(streams, args_list):
+            executor.submit(run_one, stream, args)
+
+        for stream, args in zip(streams, args_list):
+            while True:
+                kind, value = stream.get()
+
+                if kind == "error":
+                    raise value
+
+                yield (args, kind, value)
+
+                if kind == "result":
+                    break
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+# Number of times a throttled or failed request is retried when a rate limiter is in use
+MAX_RATE_LIMITED_RETRIES = 8
+
+class AdaptiveRateLimiter:
+    """Token bucket whose refill rate adapts to the API's responses.
+
+    The rate grows additively while requests succeed and halves whenever the
+    API throttles (HTTP 429, rate limit errors) or fails (HTTP 5xx). A
+    Retry-After header pauses all callers for the requested time. Safe to
+    share between threads."""
+
+    def __init__(self, initial_rate=2.0, min_rate=0.2, max_rate=50.0, increase_step=0.25):
+        self.rate           = initial_rate
+        self.min_rate       = min_rate
+        self.max_rate       = max_rate
+        self.increase_step  = increase_step
+        self.tokens         = 1.0
+        self.last_refill    = time.monotonic()
+        self.blocked_until  = 0.0
+        self.lock           = threading.Lock()
+
+    def acquire(self):
+        """Block until a request may be sent"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                # Allow bursts of up to one second's worth of requests
+                capacity = max(1.0, self.rate)
+                self.tokens = min(capacity, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+
+                if now >= self.blocked_until and self.tokens >= 1.0:
+                    self.tokens = self.tokens - 1.0
+                    return
+
+                wait = max(self.blocked_until - now, (1.0 - self.tokens) / self.rate)
+
+            time.sleep(wait)
+
+    def on_success(self):
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.increase_step)
+
+    def on_throttle(self, retry_after=None):
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0.0
+            if retry_after:
+                self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+        logging.info("Throttled by Wiz API - request rate reduced to %.2f/s", self.rate)
+
+def is_throttled_response(result):
+    """Whether the API asked us to slow down or failed server-side"""
+    if result.status_code == 429 or result.status_code >= 500:
+        return True
 
     try:
-        # Uncomment the next first line and comment the line after that
-        # to run behind proxies
-        # result = requests.post(url="https://api.us20.app.wiz.io/graphql",
-        #                        json=data, headers=HEADERS, proxies=proxyDict)
-        result = requests.post(url="https://api." + wiz_dc + ".app.wiz.io/graphql",
-                               json=data, headers=HEADERS, timeout=60)
-
-    except Exception as e:
-        if ('502: Bad Gateway' not in str(e) and
-                '503: Service Unavailable' not in str(e) and
-                '504: Gateway Timeout' not in str(e)):
-            logging.ERROR("Wiz-API-Error: %s", str(e))
+        errors = result.json().get("errors") or []
+    except ValueError:
+        return False
+
+    for error in errors:
+        if "rate limit" in str(error.get("message", "")).lower():
+            return True
+
+    return False
+
+def get_retry_after(result):
+    """Seconds to wait according to the Retry-After header, if present"""
+    try:
+        return float(result.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+def query_wiz_api(query, variables, wiz_dc, rate_limiter=None):
+    """Query Wiz API for the given query data schema
+
+    When a rate_limiter is given, requests are paced by it and throttled or
+    failed requests are retried after backing off."""
+    data = {"variables": variables, "query": query}
+    attempt = 0
+
+    while True:
+        if rate_limiter is not None:
+            rate_limiter.acquire()
+
+        try:
+            result = get_wiz_session().post(url="https://api." + wiz_dc + ".app.wiz.io/graphql",
+                                            json=data, timeout=60)
+
+        except Exception as e:
+            transient = (isinstance(e, (requests.Timeout, requests.ConnectionError)) or
+                         '502: Bad Gateway' in str(e) or
+                         '503: Service Unavailable' in str(e) or
+                         '504: Gateway Timeout' in str(e))
+
+            if rate_limiter is not None and transient and attempt < MAX_RATE_LIMITED_RETRIES:
+                print("Retry")
+                rate_limiter.on_throttle()
+                attempt = attempt + 1
+                continue
+
+            logging.error("Wiz-API-Error: %s", str(e))
             return(e)
-        else:
-            print("Retry")
 
-    return result.json()
+        if rate_limiter is not None:
+            if is_throttled_response(result):
+                rate_limiter.on_throttle(get_retry_after(result))
+                attempt = attempt + 1
+                if attempt <= MAX_RATE_LIMITED_RETRIES:
+                    continue
+            else:
+                rate_limiter.on_success()
+
+        return result.json()
+
+class WizApiError(Exception):
+    """A request failed, or the API answered it with errors instead of data"""
+
+class ResultCapError(Exception):
+    """The API returned no results for a connection because the query
+    matched more than it will page through (see GRAPH_SEARCH_RESULT_CAP)"""
+
+def iter_connection_pages(query, variables, wiz_dc, connection, request_slots=None):
+    """Yield the nodes of each page of the named connection (e.g. "projects"),
+    following pageInfo.endCursor until there are no further pages.
+
+    When request_slots (a semaphore) is given, it is held while each page is
+    requested, so paginators sharing it have at most its value of requests in
+    flight between them.
+
+    Raises WizApiError if a request fails or is answered with errors, and
+    ResultCapError if the connection itself comes back null."""
+    variables = dict(variables)
+
+    while True:
+        with request_slots if request_slots is not None else contextlib.nullcontext():
+            results = query_wiz_api(query, variables, wiz_dc)
+
+        if isinstance(results, Exception):
+            raise WizApiError(str(results)) from results
+
+        data = results.get("data")
+
+        if data is not None and connection in data and data[connection] is None:
+            raise ResultCapError(str(results.get("errors")))
+
+        if data is None or results.get("errors"):
+            raise WizApiError(str(results.get("errors")))
+
+        connection_results = data[connection]
+
+        yield connection_results["nodes"]
+
+        page_info = connection_results["pageInfo"]
+        if not page_info["hasNextPage"]:
+            break
+
+        logging.info("Paginating on " + connection)
+        variables["after"] = page_info["endCursor"]
+
+
+# Number of pages a prefetching paginator may hold ahead of its consumer
+PREFETCH_QUEUE_SIZE = 2
+
+def iter_connection_pages_prefetch(query, variables, wiz_dc, connection, queue_size=PREFETCH_QUEUE_SIZE, request_slots=None):
+    """As iter_connection_pages, but pages are fetched by a background thread which
+    requests the next page as soon as its cursor is known, so the network and the
+    consumer's processing overlap. At most queue_size pages are held in memory."""
+    pages = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    finished = object()
+
+    def put(item):
+        # Gives up if the consumer has gone away
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def fetch_pages():
+        try:
+            for page in iter_connection_pages(query, variables, wiz_dc, connection, request_slots):
+                if not put(page):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        put(finished)
+
+    threading.Thread(target=fetch_pages, daemon=True).start()
+
+    try:
+        while True:
+            item = pages.get()
+            if item is finished:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
 
 
 def request_wiz_api_token(client_id, client_secret):
@@ -57,23 +349,112 @@ def request_wiz_api_token(client_id, client_secret):
                     response_json.get("message"))
             raise Exception(message)
     except ValueError as exception:
-        logging.ERROR(exception)
+        logging.error(exception)
         raise Exception('Could not parse API response')
-    HEADERS["Authorization"] = "Bearer " + TOKEN
+    get_wiz_session().headers["Authorization"] = "Bearer " + TOKEN
 
     return TOKEN
 
+# Variables shared by every graphSearch built below. Exposure, lateral movement
+# and other enrichment fetches are left off: the scripts only read entity names
+# and properties.
+GRAPH_SEARCH_LEAN_VARS = {
+  "quick": False,
+  "projectId": "*",
+  "fetchTotalCount": False
+}
+
+def get_qry_graph_search_lean():
+    """graphSearch returning only the identity and properties of each entity"""
+    return """
+        query GraphSearch(
+            $query: GraphEntityQueryInput
+            $projectId: String!
+            $first: Int
+            $after: String
+            $fetchTotalCount: Boolean = false
+            $quick: Boolean = true
+        ) {
+            graphSearch(
+            query: $query
+            projectId: $projectId
+            first: $first
+            after: $after
+            quick: $quick
+            ) {
+            totalCount @include(if: $fetchTotalCount)
+            maxCountReached @include(if: $fetchTotalCount)
+            pageInfo {
+                endCursor
+                hasNextPage
+            }
+            nodes {
+                entities {
+                id
+                name
+                type
+                properties
+                }
+            }
+            }
+        }
+    """
+
+# graphSearch stops returning results after this many rows for a single query
+GRAPH_SEARCH_RESULT_CAP = 10000
+
+def get_qry_vars_child_entities(root_management_group_id):
+  """Direct child management groups and subscriptions of a management group.
+  Each result row is [management group, child]."""
+  return {
+    **GRAPH_SEARCH_LEAN_VARS,
+    "first": 500,
+    "query": {
+      "type": [
+        "CLOUD_ORGANIZATION"
+      ],
+      "select": True,
+      "where": {
+        "externalId": {
+          "EQUALS": [
+            root_management_group_id
+          ]
+        }
+      },
+      "relationships": [
+        {
+          "type": [
+            {
+              "type": "CONTAINS"
+            }
+          ],
+          "with": {
+            "type": [
+              "CLOUD_ORGANIZATION",
+              "SUBSCRIPTION"
+            ],
+            "select": True
+          }
+        }
+      ]
+    }
+  }
+
+def get_qry_vars_partition(variables):
+  """Make the top-level relationships of a project structure query optional, so
+  that a query rooted at a management group without child management groups
+  still returns its subscriptions"""
+  for relationship in variables["query"]["relationships"]:
+    relationship["optional"] = True
+
+  return variables
+
 def get_qry_vars_grp_members_for_subscriptions(external_id, cloud):
 
   if cloud != "AWS":
 
     return {
-      "quick": False,
-      "fetchPublicExposurePaths": True,
-      "fetchInternalExposurePaths": False,
-      "fetchIssueAnalytics": False,
-      "fetchLateralMovement": True,
-      "fetchKubernetes": False,
+      **GRAPH_SEARCH_LEAN_VARS,
       "first": 500,
       "query": {
           "type": [
@@ -129,17 +510,10 @@ def get_qry_vars_grp_members_for_subscriptions(external_id, cloud):
             }
           ]
         },
-      "projectId": "*",
-      "fetchTotalCount": False
     }
   else:
      return {
-      "quick": False,
-      "fetchPublicExposurePaths": True,
-      "fetchInternalExposurePaths": False,
-      "fetchIssueAnalytics": False,
-      "fetchLateralMovement": True,
-      "fetchKubernetes": False,
+      **GRAPH_SEARCH_LEAN_VARS,
       "first": 500,
       "query": {
           "type": [
@@ -195,18 +569,24 @@ def get_qry_vars_grp_members_for_subscriptions(external_id, cloud):
             }
           ]
         },
-      "projectId": "*",
-      "fetchTotalCount": False
     }
 
+def get_qry_vars_grp_members_for_subscriptions_batch(external_ids, cloud):
+  """As get_qry_vars_grp_members_for_subscriptions, but matches many subscriptions
+  at once. The SUBSCRIPTION entity is selected so that each result row can be
+  attributed back to its subscription via entities[1]."""
+
+  variables = get_qry_vars_grp_members_for_subscriptions(None, cloud)
+
+  subscription_query = variables["query"]["relationships"][0]["with"]["relationships"][0]["with"]
+  subscription_query["where"]["externalId"]["EQUALS"] = list(external_ids)
+  subscription_query["select"] = True
+
+  return variables
+
 def get_qry_vars_grp_members_for_mgmt_groups(external_id, cloud):
   return {
-    "quick": False,
-    "fetchPublicExposurePaths": True,
-    "fetchInternalExposurePaths": False,
-    "fetchIssueAnalytics": False,
-    "fetchLateralMovement": True,
-    "fetchKubernetes": False,
+    **GRAPH_SEARCH_LEAN_VARS,
     "first": 500,
     "query": {
       "type": [
@@ -262,8 +642,6 @@ def get_qry_vars_grp_members_for_mgmt_groups(external_id, cloud):
         }
       ]
     },
-    "projectId": "*",
-    "fetchTotalCount": False
   }
 
 def get_qry_grp_role_bindings():
@@ -367,12 +745,7 @@ def get_qry_grp_role_bindings():
 
 def get_qry_vars_grp_azure_role_bindings_for_subscriptions(subscription_id):
     return {
-  "quick": False,
-  "fetchPublicExposurePaths": True,
-  "fetchInternalExposurePaths": False,
-  "fetchIssueAnalytics": False,
-  "fetchLateralMovement": True,
-  "fetchKubernetes": False,
+  **GRAPH_SEARCH_LEAN_VARS,
   "first": 50,
   "query": {
     "type": [
@@ -428,18 +801,11 @@ def get_qry_vars_grp_azure_role_bindings_for_subscriptions(subscription_id):
       }
     ]
   },
-  "projectId": "*",
-  "fetchTotalCount": False
 }
 
 def get_qry_vars_grp_azure_role_bindings_for_mgmtgrp(management_group_id):
      return {
-      "quick": False,
-      "fetchPublicExposurePaths": True,
-      "fetchInternalExposurePaths": False,
-      "fetchIssueAnalytics": False,
-      "fetchLateralMovement": True,
-      "fetchKubernetes": False,
+      **GRAPH_SEARCH_LEAN_VARS,
       "first": 50,
       "query": {
         "type": [
@@ -495,18 +861,11 @@ def get_qry_vars_grp_azure_role_bindings_for_mgmtgrp(management_group_id):
           }
         ]
       },
-      "projectId": "*",
-      "fetchTotalCount": False
     }
 
 def get_qry_vars_grp_aws_role_bindings_for_subscriptions(subscription_id):
   return {
-  "quick": False,
-  "fetchPublicExposurePaths": True,
-  "fetchInternalExposurePaths": False,
-  "fetchIssueAnalytics": False,
-  "fetchLateralMovement": True,
-  "fetchKubernetes": False,
+  **GRAPH_SEARCH_LEAN_VARS,
   "first": 500,
   "query": {
     "type": [
@@ -584,8 +943,6 @@ def get_qry_vars_grp_aws_role_bindings_for_subscriptions(subscription_id):
       }
     }
   },
-  "projectId": "*",
-  "fetchTotalCount": False
 }
 def get_qry_project_structure():
     return """
@@ -699,12 +1056,7 @@ def get_qry_project_structure():
 
 def get_qry_vars_azure_project_structure_excl_burners(root_management_group_id, burner_mg_id):
   return {
-  "quick": False,
-  "fetchPublicExposurePaths": True,
-  "fetchInternalExposurePaths": False,
-  "fetchIssueAnalytics": False,
-  "fetchLateralMovement": True,
-  "fetchKubernetes": False,
+  **GRAPH_SEARCH_LEAN_VARS,
   "first": 500,
   "query": {
     "type": [
@@ -961,18 +1313,11 @@ def get_qry_vars_azure_project_structure_excl_burners(root_management_group_id,
       }
     ]
   },
-  "projectId": "*",
-  "fetchTotalCount": False
 }
 
 def get_qry_vars_azure_project_structure_burners(root_management_group_id, burner_mg_id):
   return {
-    "quick": False,
-    "fetchPublicExposurePaths": True,
-    "fetchInternalExposurePaths": False,
-    "fetchIssueAnalytics": False,
-    "fetchLateralMovement": True,
-    "fetchKubernetes": False,
+    **GRAPH_SEARCH_LEAN_VARS,
     "first": 500,
     "query": {
       "type": [
@@ -1194,18 +1539,11 @@ def get_qry_vars_azure_project_structure_burners(root_management_group_id, burne
         }
       ]
     },
-    "projectId": "*",
-    "fetchTotalCount": False
 }
 
 def get_qry_vars_project_structure_no_burners(root_management_group_id, cloud):
   return {
-  "quick": False,
-  "fetchPublicExposurePaths": True,
-  "fetchInternalExposurePaths": False,
-  "fetchIssueAnalytics": False,
-  "fetchLateralMovement": True,
-  "fetchKubernetes": False,
+  **GRAPH_SEARCH_LEAN_VARS,
   "first": 500,
   "query": {
     "type": [
@@ -1420,18 +1758,11 @@ def get_qry_vars_project_structure_no_burners(root_management_group_id, cloud):
       }
     ]
   },
-  "projectId": "*",
-  "fetchTotalCount": False
 }
 
 def get_qry_vars_gcp_project_structure_excl_burners(root_management_group_id, burner_mg_id):
   return {
-    "quick": False,
-    "fetchPublicExposurePaths": True,
-    "fetchInternalExposurePaths": False,
-    "fetchIssueAnalytics": False,
-    "fetchLateralMovement": True,
-    "fetchKubernetes": False,
+    **GRAPH_SEARCH_LEAN_VARS,
     "first": 500,
     "query": {
       "type": [
@@ -1594,18 +1925,11 @@ def get_qry_vars_gcp_project_structure_excl_burners(root_management_group_id, bu
         }
       ]
     },
-  "projectId": "*",
-  "fetchTotalCount": False
 }
 
 def get_qry_vars_aws_project_structure(root_management_group_id):
   return {
-    "quick": False,
-    "fetchPublicExposurePaths": True,
-    "fetchInternalExposurePaths": False,
-    "fetchIssueAnalytics": False,
-    "fetchLateralMovement": True,
-    "fetchKubernetes": False,
+    **GRAPH_SEARCH_LEAN_VARS,
     "first": 500,
     "query": {
     "type": [
@@ -1725,8 +2049,6 @@ def get_qry_vars_aws_project_structure(root_management_group_id):
       }
     ]
   }, 
-  "projectId": "*",
-  "fetchTotalCount": False
 }
 
 def get_qry_all_projects():
@@ -1850,6 +2172,61 @@ def get_qry_vars_child_projects(parent_project_id, include_archived):
     "fetchOverdueAndCreatedVsResolvedTrend": True
   }
 
+# Skinny projects query for walking the project tree. Only the fields needed to
+# identify, rename and archive projects are requested - no analytics or trends.
+def get_qry_project_tree():
+
+  return """
+    query ProjectTree($filterBy: ProjectFilters, $first: Int, $after: String, $orderBy: ProjectOrder) {
+      projects(filterBy: $filterBy, first: $first, after: $after, orderBy: $orderBy) {
+        nodes {
+          id
+          name
+          slug
+          archived
+          isFolder
+          childProjectCount
+        }
+        pageInfo {
+          hasNextPage
+          endCursor
+        }
+      }
+    }
+"""
+
+# The variables sent along with the above query
+def get_qry_vars_project_tree_root(project_id, include_archived):
+  return {
+    "first": 500,
+    "filterBy": {
+      "id": {
+        "equals": [
+          project_id
+        ]
+      },
+      "root": True,
+      "includeArchived": include_archived
+    },
+    "orderBy": {
+      "field": "IS_FOLDER",
+      "direction": "DESC"
+    }
+  }
+
+def get_qry_vars_project_tree_children(parent_project_id, include_archived):
+  return {
+    "first": 500,
+    "filterBy": {
+      "parentProjectId": parent_project_id,
+      "includeArchived": include_archived
+    },
+    "orderBy": {
+      "field": "IS_FOLDER",
+      "direction": "DESC"
+    }
+  }
+
 def get_qry_update_project():
   return """
     mutation UpdateProject($input: UpdateProjectInput!) {